@@ -0,0 +1,8 @@
+import os
+import sys
+
+# The driver is run as a script from its own directory so its modules import each other without
+# the package name. Make them importable the same way here
+DRIVER_DIR = os.path.join(os.path.dirname(os.path.dirname(os.path.realpath(__file__))), 'driver')
+if DRIVER_DIR not in sys.path:
+    sys.path.insert(0, DRIVER_DIR)
@@ -0,0 +1,146 @@
+"""
+Run with `python -m benchmarks` from the repository root
+
+Usage:
+    benchmarks
+        [ -n=<val> | --reports=<val> ]
+        [ -a=<val> | --action=<val> ]
+        [ -o=<val> | --output=<val> ]
+        [ --compare=<file> ]
+
+Options:
+    -n=<val>, --reports=<val>
+        Number of reports in every synthetic stream [default: 20000]
+    -a=<val>, --action=<val>
+        Action profile from the default config to benchmark with.
+        Uses default_action if this is not provided
+    -o=<val>, --output=<val>
+        Where to write the JSON results. By default they are
+        written to benchmarks/results/ with a timestamp in the
+        file name
+    --compare=<file>
+        Print the change in reports/sec and allocations against
+        the results stored in <file>
+
+Also measures the overhead of the pen smoothing filters on the drawing
+stream and exits with status 1 if any of them goes over its budget
+"""
+
+from __future__ import print_function
+import os
+import sys
+import json
+import time
+import platform
+import subprocess
+
+from docopt import docopt
+import yaml
+
+from . import DRIVER_DIR
+from .hot_path import run_benchmark
+from .smoothing import run_smoothing_benchmark, SMOOTHING_BUDGET_NS
+
+# CONSTANTS ---------------------------------------------------------------------------------------
+
+RESULTS_DIR = os.path.join(os.path.dirname(os.path.realpath(__file__)), 'results')
+CONFIG_PATH = os.path.join(DRIVER_DIR, 'config.yaml')
+
+COLUMNS = (
+    ('reports_per_sec', 'reports/s', '{:.0f}'),
+    ('ns_per_report', 'ns/report', '{:.0f}'),
+    ('events_per_report', 'events/report', '{:.2f}'),
+    ('writes_per_report', 'writes/report', '{:.2f}'),
+    ('transient_bytes_per_report', 'alloc B/report', '{:.1f}'),
+    ('retained_blocks_per_report', 'kept blocks/report', '{:.3f}'),
+)
+
+# HELPERS -----------------------------------------------------------------------------------------
+
+def get_git_commit():
+    try:
+        return subprocess.check_output(
+            ['git', 'rev-parse', '--short', 'HEAD'],
+            cwd=DRIVER_DIR,
+            stderr=subprocess.DEVNULL
+        ).decode().strip()
+    except Exception:
+        return ''
+
+def print_results(results, previous=None):
+    from tabulate import tabulate
+
+    rows = []
+    for name, result in results.items():
+        row = [name]
+        for key, _, value_format in COLUMNS:
+            cell = value_format.format(result[key])
+            if previous and name in previous and previous[name].get(key):
+                change = (result[key] - previous[name][key]) / previous[name][key] * 100
+                cell += ' ({:+.1f}%)'.format(change)
+            row.append(cell)
+        rows.append(row)
+
+    print(tabulate(rows, headers=['stream'] + [header for _, header, _ in COLUMNS]))
+
+def print_smoothing_results(baseline_ns, results):
+    from tabulate import tabulate
+
+    rows = [['none', '{:.0f}'.format(baseline_ns), '', '', '']]
+    for name, result in results.items():
+        rows.append([
+            name,
+            '{:.0f}'.format(result['ns_per_report']),
+            '{:+.0f}'.format(result['overhead_ns_per_report']),
+            '{:.3f}'.format(result['retained_blocks_per_report']),
+            'ok' if result['within_budget'] else 'OVER BUDGET',
+        ])
+
+    print('\nSmoothing on the drawing stream (budget {} ns/report)'.format(SMOOTHING_BUDGET_NS))
+    print(tabulate(rows, headers=['filter', 'ns/report', 'overhead ns', 'kept blocks/report', '']))
+
+# MAIN --------------------------------------------------------------------------------------------
+
+def run_main():
+    args = docopt(__doc__)
+
+    with open(CONFIG_PATH, 'r') as yaml_file:
+        config = yaml.safe_load(yaml_file)
+
+    action = args['--action'] or config['default_action']
+    results = run_benchmark(config, action, int(args['--reports']))
+
+    previous = None
+    if args['--compare']:
+        with open(args['--compare'], 'r') as previous_file:
+            previous = json.load(previous_file)['results']
+
+    print_results(results, previous)
+
+    baseline_ns, smoothing_results = run_smoothing_benchmark(config, action, int(args['--reports']))
+    print_smoothing_results(baseline_ns, smoothing_results)
+
+    output_path = args['--output']
+    if not output_path:
+        if not os.path.isdir(RESULTS_DIR):
+            os.makedirs(RESULTS_DIR)
+        output_path = os.path.join(RESULTS_DIR, 'hot_path-{}.json'.format(time.strftime('%Y%m%d-%H%M%S')))
+
+    with open(output_path, 'w') as output_file:
+        json.dump({
+            'timestamp': time.time(),
+            'git_commit': get_git_commit(),
+            'python': platform.python_version(),
+            'machine': platform.machine(),
+            'action': action,
+            'results': results,
+            'smoothing': smoothing_results,
+        }, output_file, indent=4, sort_keys=True)
+
+    print('\nResults written to {}'.format(output_path))
+
+    if not all(result['within_budget'] for result in smoothing_results.values()):
+        sys.exit(1)
+
+if __name__ == '__main__':
+    run_main()
@@ -0,0 +1,122 @@
+"""
+Drives the driver's per-report path (decode, dispatch, actions and the uinput emitter) with the
+synthetic report streams and measures how fast and how cheaply every report is processed.
+"""
+
+import json
+import time
+import tracemalloc
+
+import kamvas_driver
+
+from .streams import STREAMS, ReportBuilder
+
+# CONSTANTS ---------------------------------------------------------------------------------------
+
+# Reports processed one at a time under tracemalloc. This is much slower than the timed run so
+# only a sample of every stream is used
+ALLOCATION_SAMPLE_SIZE = 2000
+
+# Time between the synthetic reports, as seen by anything that looks at the report timestamps
+REPORT_INTERVAL_NS = 5000000
+
+# HELPERS -----------------------------------------------------------------------------------------
+
+def setup_driver(config, action):
+    # Parse the arguments exactly like the driver would when started by the CLI, but with the
+    # stand-in uinput device so nothing reaches the system
+    kamvas_driver.args = kamvas_driver.get_args([
+        config['xinput_name'],
+        str(config['vendor_id']),
+        str(config['product_id']),
+        json.dumps(config['pen']),
+        json.dumps(config['actions'][action]),
+        json.dumps(config['report_layouts'][0]),
+        '--fake-uinput',
+        '--quiet-mode',
+    ])
+    return kamvas_driver.create_devices()[0]
+
+def run_reports(device, reports):
+    device.open_output()
+    device.setup_pipeline(max(len(report) for report in reports))
+    report_view = device.report_view
+    process_report = device.process_report
+
+    start_time = time.perf_counter()
+    for index, report in enumerate(reports):
+        device.report_time_ns = index * REPORT_INTERVAL_NS
+        length = len(report)
+        report_view[:length] = report
+        process_report(length)
+    elapsed = time.perf_counter() - start_time
+
+    stats = device.emitter.get_stats()
+    device.close_output()
+    return elapsed, stats
+
+def measure_allocations(device, reports):
+    device.open_output()
+    device.setup_pipeline(max(len(report) for report in reports))
+    report_view = device.report_view
+    process_report = device.process_report
+
+    # Net blocks that are still alive after the reports catch leaks and growing state. The peak
+    # above the starting point catches short lived allocations like temporary strings and tuples
+    tracemalloc.start()
+    before = tracemalloc.take_snapshot()
+    peak_bytes = 0
+    for index, report in enumerate(reports):
+        device.report_time_ns = index * REPORT_INTERVAL_NS
+        length = len(report)
+        report_view[:length] = report
+
+        tracemalloc.reset_peak()
+        current_before, _ = tracemalloc.get_traced_memory()
+        process_report(length)
+        _, peak = tracemalloc.get_traced_memory()
+        peak_bytes += peak - current_before
+    after = tracemalloc.take_snapshot()
+    tracemalloc.stop()
+
+    device.close_output()
+
+    net_blocks = sum(
+        stat.count_diff
+        for stat in after.compare_to(before, 'filename')
+        if stat.traceback[0].filename != tracemalloc.__file__
+    )
+
+    return {
+        'transient_bytes_per_report': peak_bytes / float(len(reports)),
+        'retained_blocks_per_report': net_blocks / float(len(reports)),
+    }
+
+# BENCHMARK ---------------------------------------------------------------------------------------
+
+def run_benchmark(config, action, report_count, repeat=3):
+    device = setup_driver(config, action)
+    builder = ReportBuilder(config['report_layouts'][0])
+
+    results = {}
+    for name, make_stream in STREAMS:
+        reports = make_stream(builder, config['pen'], report_count)
+
+        # Use the best of the repeated runs to keep scheduler noise out of the numbers
+        elapsed, stats = min(
+            (run_reports(device, reports) for _ in range(repeat)),
+            key=lambda run: run[0]
+        )
+
+        result = {
+            'reports': len(reports),
+            'reports_per_sec': len(reports) / elapsed,
+            'ns_per_report': elapsed * 1e9 / len(reports),
+            'events_per_report': stats['events_written'] / float(len(reports)),
+            'suppressed_events_per_report': stats['events_suppressed'] / float(len(reports)),
+            'writes_per_report': stats['frames_written'] / float(len(reports)),
+        }
+        result.update(measure_allocations(device, reports[:ALLOCATION_SAMPLE_SIZE]))
+        results[name] = result
+
+    return results
@@ -0,0 +1,50 @@
+"""
+Measures what the pen smoothing filters add to every report by running the drawing stream through
+the driver without a filter and with each of them.
+"""
+
+import copy
+
+from .streams import ReportBuilder, drawing_stream
+from .hot_path import setup_driver, run_reports, measure_allocations, ALLOCATION_SAMPLE_SIZE
+
+# CONSTANTS ---------------------------------------------------------------------------------------
+
+# Most CPU time a filter may add to a report. At the tablet's 200 reports/s this keeps smoothing
+# well under 0.1% of a core
+SMOOTHING_BUDGET_NS = 2500
+
+FILTER_SETTINGS = (
+    ('one_euro', {'filter': 'one_euro', 'min_cutoff': 1.0, 'beta': 0.007}),
+    ('ema', {'filter': 'ema', 'time_constant_ms': 8}),
+)
+
+# BENCHMARK ---------------------------------------------------------------------------------------
+
+def get_best_time(device, reports, repeat):
+    return min(run_reports(device, reports)[0] for _ in range(repeat))
+
+def run_smoothing_benchmark(config, action, report_count, repeat=5):
+    builder = ReportBuilder(config['report_layouts'][0])
+    reports = drawing_stream(builder, config['pen'], report_count)
+
+    baseline_device = setup_driver(config, action)
+    baseline_ns = get_best_time(baseline_device, reports, repeat) * 1e9 / len(reports)
+
+    results = {}
+    for name, settings in FILTER_SETTINGS:
+        filter_config = copy.deepcopy(config)
+        filter_config['actions'][action]['smoothing'] = settings
+        device = setup_driver(filter_config, action)
+
+        ns_per_report = get_best_time(device, reports, repeat) * 1e9 / len(reports)
+        result = {
+            'ns_per_report': ns_per_report,
+            'overhead_ns_per_report': ns_per_report - baseline_ns,
+            'budget_ns_per_report': SMOOTHING_BUDGET_NS,
+            'within_budget': ns_per_report - baseline_ns <= SMOOTHING_BUDGET_NS,
+        }
+        result.update(measure_allocations(device, reports[:ALLOCATION_SAMPLE_SIZE]))
+        results[name] = result
+
+    return baseline_ns, results
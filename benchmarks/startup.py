@@ -0,0 +1,168 @@
+"""
+Run with `python -m benchmarks.startup` from the repository root
+
+Usage:
+    startup
+        [ -r=<val> | --runs=<val> ]
+        [ -o=<val> | --output=<val> ]
+        [ --compare=<file> ]
+
+Options:
+    -r=<val>, --runs=<val>
+        How many times every command is started. The median is
+        reported [default: 10]
+    -o=<val>, --output=<val>
+        Where to write the JSON results. By default they are
+        written to benchmarks/results/ with a timestamp in the
+        file name
+    --compare=<file>
+        Print the change in startup time against the results
+        stored in <file>
+"""
+
+from __future__ import print_function
+import os
+import sys
+import json
+import time
+import shutil
+import tempfile
+import platform
+import subprocess
+
+from docopt import docopt
+
+from . import DRIVER_DIR
+from .__main__ import RESULTS_DIR, get_git_commit
+
+# CONSTANTS ---------------------------------------------------------------------------------------
+
+REPO_DIR = os.path.dirname(DRIVER_DIR)
+
+# None of these need a running driver or root. They run against an empty runtime directory so a
+# driver that happens to be running is never touched
+COMMANDS = (
+    ('kamvas', ['-m', 'driver.cli']),
+    ('kamvas status', ['-m', 'driver.cli', 'status']),
+    ('kamvas stats', ['-m', 'driver.cli', 'stats']),
+    ('kamvas profile', ['-m', 'driver.cli', 'profile', 'program1']),
+    ('kamvas stop', ['-m', 'driver.cli', 'stop']),
+    ('kamvas_driver --help', [os.path.join(DRIVER_DIR, 'kamvas_driver.py'), '--help']),
+)
+
+SLOWEST_IMPORTS = 3
+
+# HELPERS -----------------------------------------------------------------------------------------
+
+def parse_importtime(output):
+    # Returns {module: cumulative us} for the modules imported directly by the program. Nested
+    # imports are indented under the module that imported them
+    imports = {}
+    for line in output.splitlines():
+        if not line.startswith('import time:') or 'cumulative' in line:
+            continue
+
+        _, cumulative, name = line[len('import time:'):].split('|')
+        if not name.startswith('  '):
+            imports[name.strip()] = int(cumulative)
+
+    return imports
+
+def run_command(argv, env):
+    start = time.perf_counter()
+    process = subprocess.run(
+        [sys.executable, '-X', 'importtime'] + argv,
+        cwd=REPO_DIR,
+        env=env,
+        stdout=subprocess.DEVNULL,
+        stderr=subprocess.PIPE,
+        universal_newlines=True
+    )
+    wall_time = time.perf_counter() - start
+
+    return wall_time, parse_importtime(process.stderr)
+
+def median(values):
+    values = sorted(values)
+    return values[len(values) // 2]
+
+def measure_command(argv, runs, env):
+    wall_times = []
+    import_times = []
+    slowest = {}
+
+    for _ in range(runs):
+        wall_time, imports = run_command(argv, env)
+        wall_times.append(wall_time)
+
+        # This includes the interpreter's own startup modules like site, which cost the same for
+        # every command
+        import_times.append(sum(imports.values()))
+        for name, cumulative in imports.items():
+            slowest[name] = max(slowest.get(name, 0), cumulative)
+
+    return {
+        'wall_ms': median(wall_times) * 1000,
+        'import_ms': median(import_times) / 1000.0,
+        'slowest_imports': sorted(slowest, key=slowest.get, reverse=True)[:SLOWEST_IMPORTS],
+    }
+
+def print_results(results, previous=None):
+    from tabulate import tabulate
+
+    rows = []
+    for name, _ in COMMANDS:
+        result = results[name]
+        row = [name]
+        for key in ('wall_ms', 'import_ms'):
+            cell = '{:.1f}'.format(result[key])
+            if previous and name in previous and previous[name].get(key):
+                change = (result[key] - previous[name][key]) / previous[name][key] * 100
+                cell += ' ({:+.1f}%)'.format(change)
+            row.append(cell)
+        row.append(', '.join(result['slowest_imports']))
+        rows.append(row)
+
+    print(tabulate(rows, headers=['command', 'startup ms', 'import ms', 'slowest imports']))
+
+# MAIN --------------------------------------------------------------------------------------------
+
+def run_main():
+    args = docopt(__doc__)
+    runs = int(args['--runs'])
+
+    runtime_dir = tempfile.mkdtemp(prefix='kamvas-startup-')
+    env = dict(os.environ, KAMVAS_RUNTIME_DIR=runtime_dir)
+
+    try:
+        results = dict((name, measure_command(argv, runs, env)) for name, argv in COMMANDS)
+    finally:
+        shutil.rmtree(runtime_dir)
+
+    previous = None
+    if args['--compare']:
+        with open(args['--compare'], 'r') as previous_file:
+            previous = json.load(previous_file)['results']
+
+    print_results(results, previous)
+
+    output_path = args['--output']
+    if not output_path:
+        if not os.path.isdir(RESULTS_DIR):
+            os.makedirs(RESULTS_DIR)
+        output_path = os.path.join(RESULTS_DIR, 'startup-{}.json'.format(time.strftime('%Y%m%d-%H%M%S')))
+
+    with open(output_path, 'w') as output_file:
+        json.dump({
+            'timestamp': time.time(),
+            'git_commit': get_git_commit(),
+            'python': platform.python_version(),
+            'machine': platform.machine(),
+            'runs': runs,
+            'results': results,
+        }, output_file, indent=4, sort_keys=True)
+
+    print('\nResults written to {}'.format(output_path))
+
+if __name__ == '__main__':
+    run_main()
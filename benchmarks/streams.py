@@ -0,0 +1,115 @@
+"""
+Synthetic USB report streams that mimic how the tablet is used. Every stream is built from the
+report layout in the config so the same scenarios can be run against any tablet model.
+"""
+
+import math
+import random
+
+from decoder import build_pen_struct
+
+# HELPERS -----------------------------------------------------------------------------------------
+
+class ReportBuilder(object):
+    def __init__(self, layout, packet_size=12):
+        self.layout = layout
+        self.packet_size = packet_size
+        self.pen_struct, self.field_order = build_pen_struct(layout['pen_fields'])
+
+        # Report IDs by the action they fire, with the hover report stored under ''
+        self.pen_report_ids = dict(
+            (action_name, int(report_id))
+            for report_id, action_name in layout['pen_reports'].items()
+        )
+
+    def report(self, report_id):
+        data = bytearray(self.packet_size)
+        data[0] = 8
+        data[self.layout['report_id_offset']] = report_id
+        return data
+
+    def pen(self, action_name, x, y, pressure=0, tilt_x=0, tilt_y=0):
+        values = {'x': x, 'y': y, 'pressure': pressure, 'tilt_x': tilt_x, 'tilt_y': tilt_y}
+
+        data = bytearray(self.packet_size)
+        self.pen_struct.pack_into(data, 0, *[values[name] for name in self.field_order])
+
+        # The struct writes zeros over the padding so the report ID has to be set afterwards
+        data[0] = 8
+        data[self.layout['report_id_offset']] = self.pen_report_ids[action_name]
+        return bytes(data)
+
+    def tablet_buttons(self, mask):
+        data = self.report(self.layout['tablet_buttons_report'])
+        data[self.layout['tablet_buttons_offset']] = mask
+        return bytes(data)
+
+    def scrollbar(self, level):
+        data = self.report(self.layout['scrollbar_report'])
+        data[self.layout['scrollbar_offset']] = level
+        return bytes(data)
+
+def pen_path(pen, count):
+    # A slow lissajous curve over the tablet area with a little sensor noise
+    rng = random.Random(0)
+    for index in range(count):
+        phase = index / 500.0
+        x = int((math.sin(phase) + 1) / 2 * pen['max_x']) + rng.randint(-2, 2)
+        y = int((math.sin(phase * 1.3) + 1) / 2 * pen['max_y']) + rng.randint(-2, 2)
+        yield index, min(max(x, 0), pen['max_x']), min(max(y, 0), pen['max_y'])
+
+# STREAMS -----------------------------------------------------------------------------------------
+
+def hover_stream(builder, pen, count):
+    # The pen moves above the surface. Pressure and tilt don't change
+    return [builder.pen('', x, y, 0, 10, -10) for _, x, y in pen_path(pen, count)]
+
+def drawing_stream(builder, pen, count):
+    # Strokes of 200 reports with the pressure ramping up and back down, hovering between them
+    reports = []
+    for index, x, y in pen_path(pen, count):
+        stroke_position = index % 250
+        if stroke_position < 200:
+            pressure = int(math.sin(math.pi * stroke_position / 200.0) * pen['max_pressure'])
+            tilt = 20 - stroke_position // 10
+            reports.append(builder.pen('pen_touch', x, y, pressure, tilt, -tilt))
+        else:
+            reports.append(builder.pen('', x, y, 0, 0, 0))
+
+    return reports
+
+def button_hold_stream(builder, pen, count):
+    # Pen buttons held down for a while, with and without the pen touching the surface
+    combos = ('pen_button_1', 'pen_button_1_touch', 'pen_button_2', 'pen_button_2_touch', '')
+    reports = []
+    for index, x, y in pen_path(pen, count):
+        action_name = combos[(index // 300) % len(combos)]
+        pressure = pen['max_pressure'] // 2 if action_name.endswith('touch') else 0
+        reports.append(builder.pen(action_name, x, y, pressure, 5, 5))
+
+    return reports
+
+def scrollbar_sweep_stream(builder, pen, count):
+    # The finger sweeps up and down the scrollbar, lifting off at the end of every sweep
+    levels = list(range(1, 8)) + list(range(7, 0, -1)) + [0]
+    return [builder.scrollbar(levels[(index // 4) % len(levels)]) for index in range(count)]
+
+def tablet_button_mash_stream(builder, pen, count):
+    # Random tablet buttons pressed in quick succession, sometimes several at once
+    rng = random.Random(0)
+    reports = []
+    mask = 0
+    for index in range(count):
+        if index % 3 == 0:
+            mask = rng.choice((0, 0, 1, 2, 4, 8, 16, 1 | 4, 2 | 8))
+        reports.append(builder.tablet_buttons(mask))
+
+    return reports
+
+STREAMS = (
+    ('hover', hover_stream),
+    ('drawing', drawing_stream),
+    ('button_hold', button_hold_stream),
+    ('scrollbar_sweep', scrollbar_sweep_stream),
+    ('tablet_button_mash', tablet_button_mash_stream),
+)
@@ -0,0 +1,29 @@
+import os
+import tempfile
+
+# ATOMIC WRITES -----------------------------------------------------------------------------------
+
+def write_file_atomically(path, text, mode=0o644, owner=None):
+    """
+    Writes text to path through a temporary file in the same directory that is then renamed over
+    path, so that nothing ever reads half a file. The driver runs as root and writes next to files
+    that users own, so the temporary file gets a random name and is created exclusively instead of
+    following whatever is already there. mode and owner, a (uid, gid) pair, are applied to the open
+    file before it is renamed
+    """
+
+    fd, temp_path = tempfile.mkstemp(
+        dir=os.path.dirname(path) or '.',
+        prefix='.{}.'.format(os.path.basename(path)),
+        suffix='.tmp'
+    )
+    try:
+        with os.fdopen(fd, 'w') as temp_file:
+            temp_file.write(text)
+            os.fchmod(temp_file.fileno(), mode)
+            if owner:
+                os.fchown(temp_file.fileno(), *owner)
+        os.replace(temp_path, path)
+    except BaseException:
+        os.unlink(temp_path)
+        raise
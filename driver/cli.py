@@ -1,26 +1,70 @@
 """
 Usage:
     kamvas
-        [ -t=<val> | --evdev-test=<val> ]
+        [ -t=<val> | --evdev-test=<val> [ --duration=<val> ] [ --csv=<val> ] ]
         [ -u | --print-usb-events ]
         [ -c | --create-default-config ]
     kamvas start
+        [ -n=<val> | --name=<val> ]
+        [ --config=<val> ]
         [ -a=<val> | --action=<val> ]
         [ -o | --print-driver-output ]
-    kamvas stop
-    kamvas status
+        [ -l=<val> | --latency-stats=<val> ]
+        [ --async-transfers=<val> ]
+        [ --key-repeat=<val> ]
+        [ --realtime [ --realtime-priority=<val> ] [ --cpus=<val> ] ]
+        [ --metrics-file=<val> ]
+        [ --timestamp-events ]
+        [ --full-probe ]
+    kamvas stop [ -n=<val> | --name=<val> ]
+    kamvas status [ -n=<val> | --name=<val> ]
+    kamvas profile <name> [ -n=<val> | --name=<val> ] [ --device=<val> ]
+    kamvas reload [ -n=<val> | --name=<val> ]
+    kamvas stats [ -n=<val> | --name=<val> ]
+    kamvas metrics [ -n=<val> | --name=<val> ]
+    kamvas record <file>
+        [ -n=<val> | --name=<val> ]
+        [ --config=<val> ]
+    kamvas replay <file>
+        [ --config=<val> ]
+        [ --realtime ]
+        [ --uinput ]
+        [ -l=<val> | --latency-stats=<val> ]
 
 Options:
+    -n=<val>, --name=<val>
+        Name of the driver instance to start or talk to. One
+        instance drives every tablet in the config's devices
+        list, so other names are only needed to run separate
+        configs side by side. Defaults to {instance}.
+        `kamvas status` lists every running instance if no
+        name is given
+    --config=<val>
+        Use this config file instead of {config_path}
+    --device=<val>
+        Only switch the profile of this tablet from the
+        config's devices list. All tablets are switched by
+        default
     -a=<val>, --action-<val>
         Define which group of button mappings you want to use.
         The button mappings are defined in {config_path}.
         If this is not provided then the script will try to use
         default_action from the config file.
     -t=<val>, --evdev-test=<val> 
-        Print out all the events that happen on your system for
-        a given event file. The event files are usually located
-        in `/dev/input/` directory. This usually required sudo
-        access
+        Print out all the key events that happen on your system
+        for a given event file and, when you press Ctrl+C, a
+        summary of its event rates, SYN_REPORT frame intervals,
+        frame sizes and timing jitter. The event files are
+        usually located in `/dev/input/` directory. This usually
+        required sudo access. If the driver was started with
+        the --timestamp-events option this also measures how
+        long the pen's events take to get from the driver to
+        evdev
+    --duration=<val>
+        Stop the evdev test after this many seconds
+    --csv=<val>
+        Write the time, interval, event count and latency of
+        every frame the evdev test sees to this CSV file
     -u, --print-usb-events
         Prints out add, remove and bind events for any USB devices
         on your system. Use this to observe data about your device
@@ -35,24 +79,63 @@ Options:
         your console. Note that driver output would get printed
         at any time because the driver runs as a separate
         process
+    --realtime
+        With start, run the driver with real-time scheduling,
+        locked memory and garbage collection only while the
+        tablet is idle, and print how steady the report timing
+        is. Use -o to see which parts of it could be enabled.
+        With replay, replay the recorded reports with their
+        original timing instead of as fast as possible
+    --realtime-priority=<val>
+        Real-time priority of the driver from 1 to 99. The
+        driver uses 10 by default
+    --cpus=<val>
+        Pin the driver to these CPUs, like 2,3 or 2-5
+    --metrics-file=<val>
+        Make the driver write its health counters to this file
+        in the Prometheus text format every 15 seconds. Point
+        it at the node exporter's textfile collector directory,
+        like /var/lib/node_exporter/textfile_collector/kamvas.prom
+    --uinput
+        Send the replayed events to a real uinput device instead
+        of discarding them. This requires sudo access
+    -l=<val>, --latency-stats=<val>
+        Make the driver time every report and append latency
+        percentiles for each processing stage to the given file
+        whenever it receives SIGUSR1 and when it exits. Use -
+        to print them to the driver output instead
+    --async-transfers=<val>
+        Keep this many asynchronous USB transfers queued on the
+        tablet instead of reading one report at a time. This
+        lowers input latency and idle wakeups but needs the
+        libusb1 python module (pip install libusb1)
+    --key-repeat=<val>
+        Make the driver repeat held keyboard keys this many
+        times per second. The driver only sends key events when
+        an action starts or stops by default and leaves
+        repeating keys to the desktop
+    --timestamp-events
+        Make the driver add an MSC_TIMESTAMP event with the time
+        it read the tablet's report to every frame it sends, so
+        that `kamvas -t` can measure the delivery latency
+    --full-probe
+        Make the driver request every USB string descriptor from
+        the tablet and refresh its probe cache. The driver only
+        requests the few descriptors that wake the tablet up
+        once it has been probed. Useful for diagnostics
 """
 
 from __future__ import print_function
-from pprint import pprint
 import os
 import sys
-import shutil
-import subprocess
-import json
 import time
 
-from pyudev import Context, Monitor, MonitorObserver
 from docopt import docopt
-import evdev
-import usb.core
-import yaml
-import psutil
-from elevate import elevate
+
+from driver.instance import DEFAULT_INSTANCE, get_socket_path, read_instance, list_instances
+
+# Everything else is imported by the handlers that need it. `kamvas status` gets called from shell
+# prompts and status bars so it should not have to load evdev, pyudev or yaml
 
 # CONSTANTS ---------------------------------------------------------------------------------------
 
@@ -63,111 +146,271 @@ DRIVER_SCRIPT = os.path.join(os.path.dirname(os.path.realpath(__file__)), 'kamva
 
 # HELPRES -----------------------------------------------------------------------------------------
 
+def get_instance_name():
+    return args['--name'] or DEFAULT_INSTANCE
+
+def get_config_path():
+    return os.path.abspath(os.path.expanduser(args['--config'])) if args['--config'] else CONFIG_PATH
+
 def load_config(action=''):
-    if not os.path.isfile(CONFIG_PATH):
-        raise Exception('Config file not found at {}. Create one using "kamvas -c"'.format(
-            CONFIG_PATH
-        ))
+    from driver.config_loader import load_compiled_config, get_profile_name
+
+    # Catch problems with the config here where the user can see them. This also compiles the
+    # config as the user so the driver can load the compiled version directly
+    config = load_compiled_config(get_config_path(), quiet=False)
+    for device in config['devices']:
+        get_profile_name(config, action or device['default_action'])
+    return config
 
-    with open(CONFIG_PATH, 'r') as yaml_file:
-        config = yaml.safe_load(yaml_file)
+def send_driver_command(command):
+    from driver.control import send_command
 
-        # Try to get the default action from the config
-        if not action:
-            action = config.get('default_action', '')
+    socket_path = get_socket_path(get_instance_name())
+    try:
+        response = send_command(command, socket_path)
+    except (IOError, OSError):
+        print('Could not reach the driver at {}. Is it running?'.format(socket_path))
+        return None
+    except ValueError:
+        print('The driver at {} sent an invalid response'.format(socket_path))
+        return None
+
+    if not response.get('ok'):
+        print('Error: {}'.format(response.get('error', 'unknown')))
+        return None
 
-        # If the default_action was also not available then throw an error
-        if not action:
-            raise Exception("You either need to define a 'default_action' in your config or use the 'kamvas -a' option to specify an action")
-        
-        config['actions'] = config['actions'][action]
-        return config
+    return response
 
 def driver_is_running():
-    for process in psutil.process_iter():
-        cmdline = process.cmdline()
-        if len(cmdline) < 3:
-            continue
+    # The driver holds a lock on its pidfile for as long as it runs so this doesn't need to look
+    # at any other process
+    return read_instance(get_instance_name()) is not None
 
-        if cmdline[2] == DRIVER_SCRIPT:
-            return True
-    else:
-        return False
+def format_uptime(start_time):
+    minutes, seconds = divmod(int(time.time() - start_time), 60)
+    hours, minutes = divmod(minutes, 60)
+    return '{}:{:02d}:{:02d}'.format(hours, minutes, seconds)
 
 # HANDLERS ----------------------------------------------------------------------------------------
 
+def get_driver_commands():
+    commands = [
+        'python',
+        DRIVER_SCRIPT,
+        '--config', get_config_path(),
+        '--instance', get_instance_name(),
+    ]
+
+    # Without a profile every tablet starts with its own default_action
+    if args['--action']:
+        commands.extend(['--profile', args['--action']])
+
+    if args['--latency-stats']:
+        latency_stats = args['--latency-stats']
+        if latency_stats != '-':
+            latency_stats = os.path.abspath(latency_stats)
+        commands.extend(['--latency-stats', latency_stats])
+
+    if args['--async-transfers']:
+        commands.extend(['--async-transfers', args['--async-transfers']])
+
+    if args['--key-repeat']:
+        commands.extend(['--key-repeat', args['--key-repeat']])
+
+    if args['--metrics-file']:
+        commands.extend(['--metrics-file', os.path.abspath(args['--metrics-file'])])
+
+    if args['--timestamp-events']:
+        commands.append('--timestamp-events')
+
+    if args['--full-probe']:
+        commands.append('--full-probe')
+
+    return commands
+
+def get_realtime_commands():
+    # Only for the live driver. Replays only get them when they are asked to keep the original
+    # timing
+    if not args['--realtime']:
+        return []
+
+    commands = ['--realtime']
+    if args['--realtime-priority']:
+        commands.extend(['--realtime-priority', args['--realtime-priority']])
+    if args['--cpus']:
+        commands.extend(['--cpus', args['--cpus']])
+
+    return commands
+
 def handle_start():
     if driver_is_running():
         print('Driver is already running')
         return
 
-    config = load_config()
+    load_config(args['--action'])
 
     # We need to run this as sudo because we can only have have access to USB as sudo
-    commands = [
-        'sudo',
-        'python',
-        DRIVER_SCRIPT,
-        config['xinput_name'],
-        str(config['vendor_id']),
-        str(config['product_id']),
-        json.dumps(config['pen']),
-        json.dumps(config['actions']),
-    ]
+    commands = ['sudo'] + get_driver_commands() + get_realtime_commands()
 
     if not args['--print-driver-output']:
         commands.append('-q')
 
-    if config.get('default_display', ''):
-        commands.append('-d')
-        commands.append(config['default_display'])
-
+    import subprocess
     subprocess.Popen(commands)
     print('Driver started')
 
 def handle_stop():
+    import signal
+    from driver.control import send_command
+
+    # Ask the driver to stop itself first. This doesn't need sudo. A driver that can't be reached
+    # or doesn't answer properly gets a SIGTERM instead
+    try:
+        response = send_command('stop', get_socket_path(get_instance_name()))
+    except (IOError, OSError, ValueError):
+        response = None
+
+    if response is not None:
+        if response.get('ok'):
+            print('Driver stopped')
+        else:
+            print('Error: {}'.format(response.get('error', 'unknown')))
+        return
+
+    instance = read_instance(get_instance_name())
+    if not instance:
+        print('Process not found: It is already dead')
+        return
+
+    if instance['pid'] is None:
+        print('Driver is still starting. Try again in a moment')
+        return
+
     # We will need sudo privileges to stop the driver because it was started as sudo
-    if os.getuid != 0:
+    if os.getuid() != 0:
+        from elevate import elevate
         elevate(graphical=False)
 
-    for process in psutil.process_iter():
-        cmdline = process.cmdline()
-        if len(cmdline) < 3:
-            continue
+    print('Process found. Terminating it.')
+    os.kill(instance['pid'], signal.SIGTERM)
 
-        if cmdline[2] == DRIVER_SCRIPT:
-            print('Process found. Terminating it.')
-            process.terminate()
-            break
-    else:
-        print('Process not found: It is already dead')
+def handle_profile(name, device_name=None):
+    command = 'switch-profile {}'.format(name)
+    if device_name:
+        command += ' {}'.format(device_name)
+
+    response = send_driver_command(command)
+    if response:
+        print('Switched {} to {} in {:.0f} us'.format(
+            ', '.join(response['devices']),
+            response['profile'],
+            response['switch_us']
+        ))
+
+def handle_reload():
+    response = send_driver_command('reload-config')
+    if response:
+        print('Config reloaded in {:.0f} us. Using {}'.format(
+            response['reload_us'],
+            ', '.join('{} on {}'.format(profile, name) for name, profile in sorted(response['profiles'].items()))
+        ))
+
+def handle_stats():
+    import json
+
+    response = send_driver_command('stats')
+    if response:
+        del response['ok']
+        print(json.dumps(response, indent=4, sort_keys=True))
+
+def handle_metrics():
+    response = send_driver_command('metrics')
+    if response:
+        print(response['text'], end='')
 
 def handle_status():
-    if driver_is_running():
-        print('Driver is currently running')
+    if args['--name']:
+        instances = [instance for instance in [read_instance(args['--name'])] if instance]
     else:
+        instances = list_instances()
+
+    if not instances:
         print('Driver is currently NOT running')
+        return
+
+    for instance in instances:
+        if instance['pid'] is None:
+            print('Driver "{}" is starting'.format(instance['name']))
+            continue
+
+        print('Driver "{}" is currently running with PID {} (up {})'.format(
+            instance['name'],
+            instance['pid'],
+            format_uptime(instance['start_time'])
+        ))
+
+def handle_record(path):
+    import subprocess
+
+    if driver_is_running():
+        print('Driver is currently running. Stop it before recording.')
+        return
+
+    load_config()
+
+    # Run the driver in the foreground so that the recording stops with Ctrl+C
+    commands = ['sudo'] + get_driver_commands() + ['--record', os.path.abspath(path)]
+    print('Recording USB reports to {}. Press Ctrl+C to stop'.format(path))
+    try:
+        subprocess.call(commands)
+    except KeyboardInterrupt:
+        pass
+
+def handle_replay(path):
+    import subprocess
+
+    load_config()
+
+    commands = get_driver_commands() + ['--replay', os.path.abspath(path)]
+    if args['--realtime']:
+        commands.extend(['--replay-realtime'] + get_realtime_commands())
+
+    # Only a real uinput device needs sudo. The replay doesn't touch the USB at all
+    if args['--uinput']:
+        commands.insert(0, 'sudo')
+    else:
+        commands.append('--fake-uinput')
+
+    subprocess.call(commands)
 
 def handle_evdev_test(event_path):
+    import evdev
+    from elevate import elevate
+
+    from driver.evdev_analyzer import analyze_device
+
     # We will need sudo privileges to access the event files
-    if os.getuid != 0:
+    if os.getuid() != 0:
         elevate(graphical=False)
 
     try:
         dev = evdev.InputDevice(event_path)
         if not dev:
             raise Exception("could not find device. The device may already be open")
-        
-        for event in dev.read_loop():
-            if event.type == evdev.ecodes.EV_KEY:
-                print(evdev.categorize(event))
+
+        duration = float(args['--duration']) if args['--duration'] else None
+        analyzer = analyze_device(dev, duration, args['--csv'])
     except Exception as e:
         print(e, file=sys.stderr)
-    except KeyboardInterrupt:
-        print('Exiting')
-        exit()
+        exit(1)
+
+    print('\n' + analyzer.format_summary())
+    if args['--csv']:
+        print('\nFrames written to {}'.format(args['--csv']))
 
 def handle_create_default_config():
+    import shutil
+
     if os.path.isfile(CONFIG_PATH):
         print('New config not created. Config file already exists at {}.'.format(CONFIG_PATH))
         return
@@ -176,6 +419,8 @@ def handle_create_default_config():
     print('New config file created at {}'.format(CONFIG_PATH))
 
 def handle_print_usb_events():
+    from pyudev import Context, Monitor, MonitorObserver
+
     def print_usb_events(action, device):
         string_to_print = '{} - {}'.format(action, device)
         for key in device.keys():
@@ -201,7 +446,8 @@ def handle_print_usb_events():
 def run_main():
     global args
     args = docopt(__doc__.format(
-        config_path=CONFIG_PATH
+        config_path=CONFIG_PATH,
+        instance=DEFAULT_INSTANCE
     ))
 
     if args['start']:
@@ -219,6 +465,30 @@ def run_main():
         handle_status()
         return
 
+    if args['profile']:
+        handle_profile(args['<name>'], args['--device'])
+        return
+
+    if args['reload']:
+        handle_reload()
+        return
+
+    if args['stats']:
+        handle_stats()
+        return
+
+    if args['metrics']:
+        handle_metrics()
+        return
+
+    if args['record']:
+        handle_record(args['<file>'])
+        return
+
+    if args['replay']:
+        handle_replay(args['<file>'])
+        return
+
     if args['--evdev-test']:
         handle_evdev_test(args['--evdev-test'])
         return
@@ -0,0 +1,426 @@
+from __future__ import print_function
+import os
+import json
+import hashlib
+
+try:
+    from atomic_file import write_file_atomically
+except ImportError:
+    from driver.atomic_file import write_file_atomically
+
+# CONSTANTS ---------------------------------------------------------------------------------------
+
+DEFAULT_CONFIG_PATH = os.path.join(os.path.dirname(os.path.realpath(__file__)), 'config.yaml')
+
+# Bump this whenever the layout of the compiled config changes so old artifacts get recompiled
+COMPILED_CONFIG_VERSION = 6
+
+ACTION_SPLIT_CHAR = '+'
+
+# Action profiles can hold these settings next to their actions
+PRESSURE_CURVE_KEY = 'pressure_curve'
+SMOOTHING_KEY = 'smoothing'
+SCROLLBAR_WHEEL_KEY = 'scrollbar_wheel'
+PROFILE_SETTINGS = (PRESSURE_CURVE_KEY, SMOOTHING_KEY, SCROLLBAR_WHEEL_KEY)
+
+PRESSURE_CURVE_KEYS = ('gamma', 'bezier', 'min', 'max')
+
+# The settings that every smoothing filter takes
+SMOOTHING_FILTERS = {
+    'one_euro': ('min_cutoff', 'beta', 'derivative_cutoff'),
+    'ema': ('time_constant_ms',),
+}
+
+SCROLLBAR_WHEEL_KEYS = ('frame_ms', 'step', 'acceleration', 'max_multiplier', 'invert')
+
+PEN_AXES = ('max_x', 'max_y', 'max_pressure', 'max_tilt_x', 'max_tilt_y', 'resolution')
+
+# Settings that every entry in the devices list can have. The ones an entry leaves out are taken
+# from the top level of the config
+DEVICE_KEYS = (
+    'xinput_name', 'vendor_id', 'product_id', 'serial', 'pen',
+    'default_action', 'default_display', 'display_area',
+)
+
+# HELPERS -----------------------------------------------------------------------------------------
+
+def read_config(path):
+    # yaml is only needed when the config has changed since it was last compiled
+    import yaml
+
+    if not os.path.isfile(path):
+        raise Exception('Config file not found at {}. Create one using "kamvas -c"'.format(path))
+
+    with open(path, 'r') as yaml_file:
+        return yaml.safe_load(yaml_file)
+
+def get_profile_name(config, profile=''):
+    # Try to get the default action from the config
+    if not profile:
+        profile = config.get('default_action', '')
+
+    # If the default_action was also not available then throw an error
+    if not profile:
+        raise Exception("You either need to define a 'default_action' in your config or use the 'kamvas -a' option to specify an action")
+
+    if profile not in config['actions']:
+        raise Exception('Action "{}" is not defined in the config'.format(profile))
+
+    return profile
+
+def get_report_layout(config):
+    report_layouts = config.get('report_layouts', [])
+
+    # Configs created before report layouts were added to it fall back to the layouts that ship
+    # with the driver
+    if not report_layouts:
+        report_layouts = read_config(DEFAULT_CONFIG_PATH).get('report_layouts', [])
+
+    for report_layout in report_layouts:
+        if report_layout['vendor_id'] == config['vendor_id'] and report_layout['product_id'] == config['product_id']:
+            return report_layout
+
+    raise Exception('No report layout found for vendor_id {:#06x} and product_id {:#06x}'.format(
+        config['vendor_id'],
+        config['product_id']
+    ))
+
+# ACTION COMPILING --------------------------------------------------------------------------------
+
+# Every KEY_* and BTN_* name that evdev knows. Filled in the first time an action is compiled
+key_names = None
+
+def get_key_code(name):
+    global key_names
+    from evdev import ecodes
+
+    if key_names is None:
+        key_names = set()
+        for names in ecodes.keys.values():
+            key_names.update(names if type(names) in (list, tuple) else [names])
+
+    # Only keys and buttons can be pressed. Names like ABS_X or SYN_REPORT would otherwise be sent
+    # as whichever key has the same number
+    if name not in key_names:
+        raise KeyError(name)
+
+    return ecodes.ecodes[name]
+
+def compile_action(action_text):
+    if not action_text:
+        return ()
+
+    return tuple(
+        get_key_code(action)
+        for action in action_text.split(ACTION_SPLIT_CHAR)
+    )
+
+def compile_actions(actions):
+    # Turn every action string in the config into a tuple of integer key codes once so that the
+    # per-report path never has to split strings or look up codes by name
+    compiled = {}
+    for name, value in actions.items():
+        if name in PROFILE_SETTINGS:
+            continue
+
+        if type(value) is list:
+            compiled[name] = tuple(compile_action(sub_value) for sub_value in value)
+        else:
+            compiled[name] = compile_action(value)
+
+    return compiled
+
+def get_action_errors(profile, actions):
+    errors = []
+    for name, value in actions.items():
+        if name in PROFILE_SETTINGS:
+            continue
+
+        for action_text in (value if type(value) is list else [value]):
+            if not action_text:
+                continue
+
+            if not isinstance(action_text, str):
+                errors.append('Action "{}" of profile "{}" has to be key names like KEY_LEFTCTRL+KEY_Z'.format(
+                    name,
+                    profile
+                ))
+                continue
+
+            for action in action_text.split(ACTION_SPLIT_CHAR):
+                if not action:
+                    errors.append('Empty key name in action "{}" of profile "{}": "{}"'.format(
+                        name,
+                        profile,
+                        action_text
+                    ))
+                    continue
+
+                try:
+                    get_key_code(action)
+                except KeyError:
+                    errors.append('Unknown key "{}" in action "{}" of profile "{}". Only KEY_ and BTN_ names can be used'.format(
+                        action,
+                        name,
+                        profile
+                    ))
+
+    return errors
+
+def compile_all_profiles(profiles):
+    # Compiles every profile and reports all broken key names at once instead of failing on the
+    # first one. A profile that doesn't compile is always an error, never left out
+    compiled_profiles = {}
+    errors = []
+    for profile, actions in profiles.items():
+        try:
+            compiled_profiles[profile] = compile_actions(actions)
+        except (KeyError, AttributeError) as e:
+            errors.extend(
+                get_action_errors(profile, actions)
+                or ['Profile "{}" could not be compiled: {!r}'.format(profile, e)]
+            )
+
+    if errors:
+        raise Exception('\n'.join(errors))
+
+    return compiled_profiles
+
+def check_pressure_curve(profile, curve):
+    def fail(problem):
+        raise Exception('The pressure_curve of profile "{}" {}'.format(profile, problem))
+
+    if type(curve) is not dict:
+        fail('has to be a mapping of {}'.format(', '.join(PRESSURE_CURVE_KEYS)))
+
+    unknown_keys = sorted(set(curve) - set(PRESSURE_CURVE_KEYS))
+    if unknown_keys:
+        fail('has unknown settings {}'.format(', '.join(unknown_keys)))
+
+    if 'gamma' in curve and 'bezier' in curve:
+        fail('can use either gamma or bezier but not both')
+
+    if 'gamma' in curve and not curve['gamma'] > 0:
+        fail('needs a gamma above 0')
+
+    if 'bezier' in curve:
+        points = curve['bezier']
+        if len(points) != 2 or any(len(point) != 2 for point in points):
+            fail('needs bezier to be two control points like [[0.25, 0.1], [0.75, 0.9]]')
+
+        # Keeping x inside 0 to 1 makes sure the curve never turns back on itself
+        if any(not 0 <= x <= 1 for x, _ in points):
+            fail('needs the x of both bezier control points to be between 0 and 1')
+
+    if not 0 <= curve.get('min', 0.0) < curve.get('max', 1.0) <= 1:
+        fail('needs 0 <= min < max <= 1')
+
+def check_smoothing(profile, smoothing):
+    def fail(problem):
+        raise Exception('The smoothing of profile "{}" {}'.format(profile, problem))
+
+    if type(smoothing) is not dict or smoothing.get('filter') not in SMOOTHING_FILTERS:
+        fail('needs a filter, which can be {}'.format(' or '.join(sorted(SMOOTHING_FILTERS))))
+
+    settings = dict(smoothing)
+    del settings['filter']
+    unknown_keys = sorted(set(settings) - set(SMOOTHING_FILTERS[smoothing['filter']]))
+    if unknown_keys:
+        fail('has settings that the {} filter doesn\'t take: {}'.format(smoothing['filter'], ', '.join(unknown_keys)))
+
+    if any(type(value) not in (int, float) or value < 0 for value in settings.values()):
+        fail('needs numbers of 0 or more for its settings')
+
+    if any(not settings.get(key, 1) > 0 for key in ('min_cutoff', 'derivative_cutoff', 'time_constant_ms')):
+        fail('needs cutoffs and time constants above 0')
+
+def check_scrollbar_wheel(profile, wheel):
+    def fail(problem):
+        raise Exception('The scrollbar_wheel of profile "{}" {}'.format(profile, problem))
+
+    # An empty section turns the wheel on with the default settings
+    if wheel is None:
+        return
+
+    if type(wheel) is not dict:
+        fail('has to be a mapping of {}'.format(', '.join(SCROLLBAR_WHEEL_KEYS)))
+
+    unknown_keys = sorted(set(wheel) - set(SCROLLBAR_WHEEL_KEYS))
+    if unknown_keys:
+        fail('has unknown settings {}'.format(', '.join(unknown_keys)))
+
+    if type(wheel.get('invert', False)) is not bool:
+        fail('needs invert to be true or false')
+
+    numbers = [value for key, value in wheel.items() if key != 'invert']
+    if any(type(value) not in (int, float) or value < 0 for value in numbers):
+        fail('needs numbers of 0 or more for its settings')
+
+    if not wheel.get('frame_ms', 1) > 0 or not wheel.get('step', 1) > 0:
+        fail('needs frame_ms and step above 0')
+
+    if not wheel.get('max_multiplier', 1) >= 1:
+        fail('needs a max_multiplier of 1 or more')
+
+def check_profile_settings(profiles):
+    for profile, actions in profiles.items():
+        if PRESSURE_CURVE_KEY in actions:
+            check_pressure_curve(profile, actions[PRESSURE_CURVE_KEY])
+
+        if SMOOTHING_KEY in actions:
+            check_smoothing(profile, actions[SMOOTHING_KEY])
+
+        if SCROLLBAR_WHEEL_KEY in actions:
+            check_scrollbar_wheel(profile, actions[SCROLLBAR_WHEEL_KEY])
+
+def load_compiled_profiles(compiled_actions):
+    # JSON turns the code tuples into lists. Lists of lists are the actions that take several
+    # key combinations
+    return dict(
+        (profile, dict(
+            (name, tuple(tuple(sub_value) for sub_value in value) if value and type(value[0]) is list else tuple(value))
+            for name, value in actions.items()
+        ))
+        for profile, actions in compiled_actions.items()
+    )
+
+# COMPILED CONFIG ---------------------------------------------------------------------------------
+
+def get_compiled_path(path):
+    return os.path.splitext(path)[0] + '.compiled.json'
+
+def get_source_paths(path):
+    # Configs without report layouts get them from the config that ships with the driver, so that
+    # one is part of what the artifact was compiled from too
+    return (path, DEFAULT_CONFIG_PATH)
+
+def get_source_stats(path):
+    return [
+        [source_stat.st_mtime_ns, source_stat.st_size]
+        for source_stat in (os.stat(source_path) for source_path in get_source_paths(path))
+    ]
+
+def get_source_hash(path):
+    source_hash = hashlib.sha256()
+    for source_path in get_source_paths(path):
+        with open(source_path, 'rb') as source_file:
+            source_hash.update(source_file.read())
+    return source_hash.hexdigest()
+
+def compile_device(config, device):
+    device_config = dict((key, config.get(key)) for key in DEVICE_KEYS)
+    device_config.update(device)
+    device_config['report_layouts'] = config.get('report_layouts', [])
+
+    name = device_config.get('name', 'default')
+    missing_axes = [axis for axis in PEN_AXES if axis not in (device_config['pen'] or {})]
+    if missing_axes:
+        raise Exception('The pen of device "{}" is missing {}'.format(name, ', '.join(missing_axes)))
+
+    if device_config['default_action'] and device_config['default_action'] not in config['actions']:
+        raise Exception('Action "{}" of device "{}" is not defined in the config'.format(
+            device_config['default_action'],
+            name
+        ))
+
+    return {
+        'name': name,
+        'xinput_name': device_config['xinput_name'],
+        'vendor_id': device_config['vendor_id'],
+        'product_id': device_config['product_id'],
+        'serial': str(device_config['serial']) if device_config['serial'] is not None else None,
+        'pen': dict((axis, device_config['pen'][axis]) for axis in PEN_AXES),
+        'report_layout': get_report_layout(device_config),
+        'default_action': device_config['default_action'] or '',
+        'default_display': device_config['default_display'],
+        'display_area': device_config['display_area'],
+    }
+
+def compile_config(config):
+    """
+    Validates the config and returns everything the driver needs from it with the actions of every
+    profile already turned into integer key codes and the report layout of every device already
+    picked. Raises an Exception describing every problem that was found
+    """
+
+    compiled_actions = compile_all_profiles(config['actions'])
+    check_profile_settings(config['actions'])
+    if config.get('default_action'):
+        get_profile_name(config)
+
+    # Configs without a devices list describe a single tablet at their top level
+    devices = [compile_device(config, device) for device in config.get('devices') or [{}]]
+
+    for key in ('name', 'xinput_name'):
+        values = [device[key] for device in devices]
+        duplicates = sorted(set(value for value in values if values.count(value) > 1))
+        if duplicates:
+            raise Exception('Every device needs its own {}. Found {} more than once'.format(
+                key,
+                ', '.join(duplicates)
+            ))
+
+    return {
+        'version': COMPILED_CONFIG_VERSION,
+        'devices': devices,
+        'default_action': config.get('default_action', ''),
+        'actions': config['actions'],
+        'compiled_actions': compiled_actions,
+    }
+
+def save_compiled_config(path, source_path, compiled):
+    # The driver runs as root. Keep the artifact owned by the config's owner so the CLI can still
+    # replace it
+    owner = None
+    source_stat = os.stat(source_path)
+    if os.getuid() == 0 and source_stat.st_uid != 0:
+        owner = (source_stat.st_uid, source_stat.st_gid)
+
+    write_file_atomically(
+        path,
+        json.dumps(compiled, separators=(',', ':'), sort_keys=True),
+        owner=owner
+    )
+
+def load_compiled_config(path, quiet=True):
+    """
+    Returns the compiled version of the config at path. The artifact next to the config is used
+    as long as the mtime and size of the config and of the packaged config haven't changed, or
+    their contents hash to the same value when they have. Otherwise the config is read and
+    compiled again and the artifact is replaced
+    """
+
+    if not os.path.isfile(path):
+        raise Exception('Config file not found at {}. Create one using "kamvas -c"'.format(path))
+
+    compiled_path = get_compiled_path(path)
+    source_stats = get_source_stats(path)
+
+    try:
+        with open(compiled_path, 'r') as compiled_file:
+            compiled = json.load(compiled_file)
+    except (IOError, OSError, ValueError):
+        compiled = None
+
+    if compiled and compiled.get('version') != COMPILED_CONFIG_VERSION:
+        compiled = None
+
+    if compiled and compiled['source_stats'] == source_stats:
+        return compiled
+
+    source_hash = get_source_hash(path)
+
+    if not compiled or compiled['source_hash'] != source_hash:
+        compiled = compile_config(read_config(path))
+        compiled['source_hash'] = source_hash
+
+    # The contents may be unchanged with only the mtime having moved, for example after a touch
+    compiled['source_stats'] = source_stats
+
+    try:
+        save_compiled_config(compiled_path, path, compiled)
+    except (IOError, OSError) as e:
+        if not quiet:
+            print('Could not write the compiled config to {}: {}'.format(compiled_path, e))
+
+    return compiled
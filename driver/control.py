@@ -0,0 +1,135 @@
+import os
+import json
+import socket
+
+try:
+    from instance import DEFAULT_INSTANCE, get_socket_path
+except ImportError:
+    from driver.instance import DEFAULT_INSTANCE, get_socket_path
+
+# CONSTANTS ---------------------------------------------------------------------------------------
+
+DEFAULT_SOCKET_PATH = get_socket_path(DEFAULT_INSTANCE)
+
+# Requests and responses are single lines so a connection never needs more than this
+MAX_MESSAGE_SIZE = 65536
+
+# SERVER ------------------------------------------------------------------------------------------
+
+class ControlServer(object):
+    """
+    Unix socket that accepts one line commands like "switch-profile program2" and answers every
+    one of them with a single line of JSON. It is served by the driver's event loop, so commands
+    always run between two reports and never in the middle of one
+    """
+
+    def __init__(self, loop, path, commands):
+        self.loop = loop
+        self.path = path
+        self.commands = commands
+        self.clients = {}
+
+        directory = os.path.dirname(path)
+        if not os.path.isdir(directory):
+            os.makedirs(directory, 0o755)
+
+        # A socket file left behind by a driver that crashed would make bind() fail
+        if os.path.exists(path):
+            os.unlink(path)
+
+        self.socket = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self.socket.bind(path)
+        self.socket.listen(8)
+        self.socket.setblocking(False)
+
+        # The driver runs with sudo but the CLI runs as the user that started it
+        os.chmod(path, 0o600)
+        if 'SUDO_UID' in os.environ:
+            os.chown(path, int(os.environ['SUDO_UID']), int(os.environ.get('SUDO_GID', -1)))
+
+        loop.add_reader(self.socket.fileno(), self.handle_accept)
+
+    def handle_accept(self):
+        try:
+            client, _ = self.socket.accept()
+        except (BlockingIOError, InterruptedError):
+            return
+
+        client.setblocking(False)
+        self.clients[client.fileno()] = (client, bytearray())
+        self.loop.add_reader(client.fileno(), lambda: self.handle_client(client))
+
+    def handle_client(self, client):
+        _, data = self.clients[client.fileno()]
+        try:
+            chunk = client.recv(4096)
+        except (BlockingIOError, InterruptedError):
+            return
+        except OSError:
+            chunk = b''
+
+        data.extend(chunk)
+        if chunk and b'\n' not in data and len(data) < MAX_MESSAGE_SIZE:
+            return
+
+        line = bytes(data).split(b'\n', 1)[0].decode('utf-8', 'replace').strip()
+        response = self.run_command(line) if line else {'ok': False, 'error': 'Empty command'}
+
+        try:
+            client.setblocking(True)
+            client.sendall((json.dumps(response) + '\n').encode('utf-8'))
+        except OSError:
+            pass
+        self.close_client(client)
+
+    def run_command(self, line):
+        parts = line.split()
+        command = self.commands.get(parts[0])
+        if not command:
+            return {'ok': False, 'error': 'Unknown command "{}"'.format(parts[0])}
+
+        try:
+            result = command(*parts[1:])
+        except Exception as e:
+            return {'ok': False, 'error': str(e)}
+
+        response = {'ok': True}
+        response.update(result or {})
+        return response
+
+    def close_client(self, client):
+        self.loop.remove_watch(client.fileno())
+        del self.clients[client.fileno()]
+        client.close()
+
+    def close(self):
+        for client, _ in list(self.clients.values()):
+            self.close_client(client)
+
+        self.loop.remove_watch(self.socket.fileno())
+        self.socket.close()
+        try:
+            os.unlink(self.path)
+        except OSError:
+            pass
+
+# CLIENT ------------------------------------------------------------------------------------------
+
+def send_command(command, path=DEFAULT_SOCKET_PATH, timeout=5):
+    # Returns the driver's response as a dict. Raises an OSError if the driver isn't listening
+    client = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    client.settimeout(timeout)
+    try:
+        client.connect(path)
+        client.sendall((command + '\n').encode('utf-8'))
+
+        data = b''
+        while b'\n' not in data:
+            chunk = client.recv(4096)
+            if not chunk:
+                break
+            data += chunk
+    finally:
+        client.close()
+
+    return json.loads(data.decode('utf-8'))
@@ -0,0 +1,64 @@
+from array import array
+import struct
+
+# CONSTANTS ---------------------------------------------------------------------------------------
+
+# Order of the values returned by ReportDecoder.decode_pen
+PEN_FIELDS = ('x', 'y', 'pressure', 'tilt_x', 'tilt_y')
+
+# DECODER -----------------------------------------------------------------------------------------
+
+def build_pen_struct(pen_fields):
+    # Build a single little endian struct format that skips over the bytes between the fields
+    fields = sorted(
+        (pen_fields[name]['offset'], pen_fields[name]['format'], name)
+        for name in PEN_FIELDS
+    )
+
+    struct_format = '<'
+    position = 0
+    for offset, field_format, name in fields:
+        if offset < position:
+            raise ValueError('Pen field "{}" overlaps the field before it'.format(name))
+
+        struct_format += 'x' * (offset - position) + field_format
+        position = offset + struct.calcsize('<' + field_format)
+
+    return struct.Struct(struct_format), tuple(name for _, _, name in fields)
+
+class ReportDecoder(object):
+    """
+    Decodes tablet reports according to a report layout from the config. USB reports are read
+    straight into a preallocated buffer and the pen fields are unpacked from it with one
+    precompiled struct, so no per-report array or bytes objects get created.
+    """
+
+    def __init__(self, layout, packet_size):
+        self.buffer = array('B', bytes(packet_size))
+
+        self.report_id_offset = layout['report_id_offset']
+        self.tablet_buttons_offset = layout['tablet_buttons_offset']
+        self.scrollbar_offset = layout['scrollbar_offset']
+        self.tablet_buttons_report = layout['tablet_buttons_report']
+        self.scrollbar_report = layout['scrollbar_report']
+
+        # JSON turns the integer report IDs into strings on the way through argv
+        self.pen_reports = dict(
+            (int(report_id), action_name)
+            for report_id, action_name in layout['pen_reports'].items()
+        )
+
+        self.pen_struct, field_order = build_pen_struct(layout['pen_fields'])
+        if field_order == PEN_FIELDS:
+            self.decode_pen = self.pen_struct.unpack_from
+        else:
+            # The fields are laid out in a different order on this model so put them back into
+            # the order the rest of the driver expects
+            indices = tuple(field_order.index(name) for name in PEN_FIELDS)
+            unpack_from = self.pen_struct.unpack_from
+
+            def decode_pen(data):
+                values = unpack_from(data)
+                return tuple(values[index] for index in indices)
+
+            self.decode_pen = decode_pen
@@ -0,0 +1,912 @@
+from __future__ import print_function
+import time
+import errno
+
+from evdev import UInput, ecodes, AbsInfo
+
+from decoder import ReportDecoder
+from emitter import EventEmitter, FakeUInput
+from display_map import build_display_transform, TRANSFORM_SHIFT
+from pressure import build_pressure_table
+from smoothing import create_smoother
+from scroll_wheel import ScrollWheel
+from diagnostics import format_usb_data, format_calculated_data
+from realtime import ReportJitter
+from idle import IDLE_AFTER_S, IDLE_AFTER_LEAVE_S
+
+# CONSTANTS ---------------------------------------------------------------------------------------
+
+# Short enough that udev events and signals are handled promptly while reading from the tablet
+USB_READ_TIMEOUT_MS = 100
+
+# A blocking read holds up every other tablet that is read the same way, so with more than one
+# of them the reads are kept short. Asynchronous transfers don't have this problem
+SHARED_READ_TIMEOUT_MS = 2
+
+# While every tablet is idle the read of a single blocking tablet waits much longer, because it
+# returns as soon as a report arrives and there is nothing else to do. Signals and udev events
+# take up to this long to handle. Shared reads stay short because a long read would hold up the
+# first report of the other tablets
+IDLE_READ_TIMEOUT_MS = 1000
+
+# Filled in by import_usb_modules(). Replays never touch the USB so they don't need them
+usb = None
+AsyncTabletReader = None
+probe_tablet = None
+XinputMapper = None
+
+# HELPERS -----------------------------------------------------------------------------------------
+
+def import_usb_modules():
+    global usb, AsyncTabletReader, probe_tablet, XinputMapper
+
+    import usb.core
+    import usb.util
+
+    from usb_async import AsyncTabletReader
+    from tablet_probe import probe_tablet
+    from display_map import XinputMapper
+
+def get_required_ecodes(compiled_profiles):
+    required_ecodes = [
+        ecodes.BTN_TOUCH,
+        ecodes.BTN_TOOL_PEN,
+        ecodes.BTN_STYLUS,
+        ecodes.BTN_STYLUS2
+    ]
+
+    # Get the ecodes for the buttons of every profile so that any of them can be switched to
+    # without having to create a new virtual pen
+    for profile in compiled_profiles.values():
+        for value in profile.values():
+            if value and type(value[0]) is tuple:
+                for sub_value in value:
+                    required_ecodes.extend(sub_value)
+            else:
+                required_ecodes.extend(value)
+
+    return sorted(set(required_ecodes))
+
+def get_event_timestamp(timestamp_ns):
+    # MSC_TIMESTAMP is a signed 32 bit value in microseconds that is allowed to wrap around
+    timestamp = timestamp_ns // 1000 & 0xffffffff
+    return timestamp - 0x100000000 if timestamp & 0x80000000 else timestamp
+
+# TABLET DEVICE -----------------------------------------------------------------------------------
+
+class TabletDevice(object):
+    """
+    Everything the driver keeps for one tablet: its virtual pen, the pipeline that turns its
+    reports into evdev events, the state of its buttons and its USB connection. The driver creates
+    one of these for every tablet in the config and serves all of them from the same event loop.
+    config is one entry of the compiled config's devices, profiles are the action profiles as they
+    are in the config and options are the driver's arguments. diagnostics is the DiagnosticsWriter
+    that --print-usb-data and --print-calculated-data go through
+    """
+
+    def __init__(self, config, profiles, compiled_profiles, options, loop=None, latency=None,
+                 recorder=None, diagnostics=None, idle_tracker=None):
+        self.name = config['name']
+        self.config = config
+        self.options = options
+        self.loop = loop
+        self.idle_tracker = idle_tracker
+        self.latency = latency
+        self.recorder = recorder
+        self.diagnostics = diagnostics
+        self.quiet = options['--quiet-mode']
+
+        # Only name the tablet when there can be more than one
+        self.message_prefix = '' if self.name == 'default' else '{}: '.format(self.name)
+
+        self.profile = config['profile']
+        self.compiled_profiles = compiled_profiles
+        self.compiled_actions = compiled_profiles[self.profile]
+        self.build_profile_settings(profiles)
+
+        self.previous_action = ()
+        self.previous_scrollbar_state = 0
+
+        # Held keys are repeated by a timer on the event loop rather than on every report
+        self.repeat_rate = int(options['--key-repeat'] or 0)
+        self.repeat_delay = int(options['--key-repeat-delay'] or 0) / 1000.0
+        self.repeat_codes = ()
+        self.repeat_timer = None
+
+        # Flushes the scroll wheel steps that were held back until the end of a frame
+        self.scroll_timer = None
+
+        self.vpen = None
+        self.emitter = None
+        self.output_key_codes = set()
+        self.output_has_wheel = False
+        # (scale_x, offset_x, scale_y, offset_y) when the driver maps the output to a display area
+        self.display_transform = None
+        self.xinput_mapper = None
+
+        self.decoder = None
+        self.report_handlers = {}
+
+        # monotonic_ns() of when the report being processed was read. Replays fill in the recorded
+        # time instead so that the smoothing filters see the original report intervals
+        self.report_time_ns = 0
+
+        # Every frame gets an MSC_TIMESTAMP with report_time_ns so that `kamvas -t` can tell how
+        # long its events took to get through evdev
+        self.timestamp_events = bool(options['--timestamp-events'])
+
+        # The pyusb device while the tablet is attached
+        self.usb_device = None
+        self.usb_endpoint = None
+        self.async_reader = None
+        self.tablet_info = []
+
+        # When the tablet was last attached, until the first report from it arrives
+        self.waiting_for_first_report_since = None
+
+        # Tablets are idle until their first report and again once the pen has left them alone
+        # for a while
+        self.idle = True
+        self.idle_timer = None
+        self.idle_entries = 0
+
+        # Health counters for `kamvas stats` and the metrics file
+        self.reports_processed = 0
+        self.report_counts = [0] * 256
+        self.read_timeouts = 0
+        # Failed USB reads by errno name
+        self.usb_errors = {}
+        self.attach_count = 0
+        self.attach_failures = 0
+        self.disconnect_count = 0
+        self.actions_fired = 0
+
+        # Only tracked in real-time mode where the driver reports how steady its reads are
+        self.jitter = ReportJitter() if options['--realtime'] else None
+
+    def print_message(self, message):
+        if not self.quiet:
+            print(self.message_prefix + message)
+
+    # ACTIONS -------------------------------------------------------------------------------------
+
+    def run_action(self, new_action):
+        # Key events are only sent when the action changes. Reports that keep the same action
+        # going, like hover reports or idle button packets, don't send anything
+        previous_action = self.previous_action
+        if new_action is previous_action or new_action == previous_action:
+            return
+
+        # Press "up" any previously pressed action
+        for action_code in previous_action:
+            self.emitter.write_key(action_code, 0)
+
+        # Press "down" the new action
+        for action_code in new_action:
+            self.emitter.write_key(action_code, 1)
+
+        self.previous_action = new_action
+        if new_action:
+            self.actions_fired += 1
+
+        if self.repeat_rate and self.loop:
+            self.start_key_repeat(new_action)
+
+    def tap_action(self, action):
+        # Scrollbar steps are events of their own rather than something that is held down, so every
+        # step presses and releases its keys even when the previous step fired the same action
+        self.run_action(())
+        if not action:
+            return
+
+        for action_code in action:
+            self.emitter.write_key(action_code, 1)
+        # The release goes into the next frame so that it isn't taken as a press that never happened
+        self.emitter.flush()
+        for action_code in reversed(action):
+            self.emitter.write_key(action_code, 0)
+        self.actions_fired += 1
+
+    def start_key_repeat(self, action):
+        if self.repeat_timer:
+            self.loop.cancel(self.repeat_timer)
+            self.repeat_timer = None
+
+        # Only keyboard keys repeat. Repeating pen and mouse buttons would look like extra clicks
+        self.repeat_codes = tuple(
+            code for code in action
+            if not ecodes.BTN_MISC <= code < ecodes.KEY_OK
+        )
+        if self.repeat_codes:
+            self.repeat_timer = self.loop.call_later(self.repeat_delay, self.repeat_keys)
+
+    def repeat_keys(self):
+        for action_code in self.repeat_codes:
+            self.emitter.write_key(action_code, 2)
+        self.emitter.flush()
+
+        self.repeat_timer = self.loop.call_later(1.0 / self.repeat_rate, self.repeat_keys)
+
+    def release_actions(self):
+        # Let go of anything that is still held down so nothing gets stuck while the tablet is away
+        self.run_action(())
+        self.emitter.flush()
+        self.previous_scrollbar_state = 0
+        self.stop_scrolling()
+
+    def set_profile(self, name):
+        # Let go of the old profile's keys before its table is dropped
+        self.release_actions()
+
+        self.profile = name
+        self.compiled_actions = self.compiled_profiles[name]
+        self.pressure_table = self.pressure_tables.get(name)
+        self.smoother = self.smoothers.get(name)
+        if self.smoother:
+            # Don't smooth the new profile's first stroke towards where the old one left off
+            self.smoother.reset()
+        self.scroll_wheel = self.scroll_wheels.get(name)
+        if self.decoder:
+            self.report_handlers = self.build_report_handlers()
+
+    def build_profile_settings(self, profiles):
+        # Every profile's pressure table and smoothing filter is built up front so that switching
+        # profiles only swaps them. Profiles without these settings pass the pen data through
+        max_pressure = self.config['pen']['max_pressure']
+        self.pressure_tables = dict(
+            (profile, build_pressure_table(actions['pressure_curve'], max_pressure))
+            for profile, actions in profiles.items()
+            if 'pressure_curve' in actions
+        )
+        self.pressure_table = self.pressure_tables.get(self.profile)
+
+        self.smoothers = dict(
+            (profile, create_smoother(actions['smoothing']))
+            for profile, actions in profiles.items()
+            if 'smoothing' in actions
+        )
+        self.smoother = self.smoothers.get(self.profile)
+
+        self.scroll_wheels = dict(
+            (profile, ScrollWheel(**(actions['scrollbar_wheel'] or {})))
+            for profile, actions in profiles.items()
+            if 'scrollbar_wheel' in actions
+        )
+        self.scroll_wheel = self.scroll_wheels.get(self.profile)
+
+    # REPORT HANDLERS -----------------------------------------------------------------------------
+
+    def make_pen_handler(self, action):
+        diagnostics = self.diagnostics if self.options['--print-calculated-data'] else None
+        message_prefix = self.message_prefix
+        write_abs = self.emitter.write_abs
+        decode_pen = self.decoder.decode_pen
+        run_action = self.run_action
+        latency = self.latency
+
+        transform = bool(self.display_transform)
+        scale_x, offset_x, scale_y, offset_y = self.display_transform or (1, 0, 1, 0)
+
+        pressure_table = self.pressure_table
+        max_pressure = self.config['pen']['max_pressure']
+
+        smoother = self.smoother
+        smooth = smoother.smooth if smoother else None
+
+        def handle_pen_report(data):
+            pen_x, pen_y, pen_pressure, pen_tilt_x, pen_tilt_y = decode_pen(data)
+            if latency:
+                latency.mark_decoded()
+
+            if smooth:
+                # Smoothing works in tablet coordinates so it happens before the display transform
+                smooth(pen_x, pen_y, self.report_time_ns)
+                pen_x = smoother.x
+                pen_y = smoother.y
+                if latency:
+                    latency.mark_smoothed(smoother.get_lag_ns())
+
+            if pressure_table:
+                pen_pressure = pressure_table[pen_pressure if pen_pressure <= max_pressure else max_pressure]
+
+            if transform:
+                pen_x = (pen_x * scale_x >> TRANSFORM_SHIFT) + offset_x
+                pen_y = (pen_y * scale_y >> TRANSFORM_SHIFT) + offset_y
+
+            # Queue the changed axes for the Xinput device so that cursor responds
+            write_abs(ecodes.ABS_X, pen_x)
+            write_abs(ecodes.ABS_Y, pen_y)
+            write_abs(ecodes.ABS_PRESSURE, pen_pressure)
+            write_abs(ecodes.ABS_TILT_X, pen_tilt_x)
+            write_abs(ecodes.ABS_TILT_Y, pen_tilt_y)
+
+            if diagnostics:
+                diagnostics.push(message_prefix, format_calculated_data, (pen_x, pen_y, pen_pressure))
+
+            run_action(action)
+
+        return handle_pen_report
+
+    def make_tablet_buttons_handler(self, actions):
+        # The report holds a bitmask of the pressed buttons. Precompute the action for every
+        # possible mask so that the highest pressed button wins without calling math.log per report
+        mask_actions = [()]
+        for mask in range(1, 256):
+            btn_index = mask.bit_length() - 1
+            mask_actions.append(actions[btn_index] if btn_index < len(actions) else ())
+        mask_actions = tuple(mask_actions)
+        tablet_buttons_offset = self.decoder.tablet_buttons_offset
+        run_action = self.run_action
+
+        def handle_tablet_buttons_report(data):
+            run_action(mask_actions[data[tablet_buttons_offset]])
+
+        return handle_tablet_buttons_report
+
+    def make_scrollbar_handler(self, increase_action, decrease_action, level_actions):
+        scrollbar_offset = self.decoder.scrollbar_offset
+        run_action = self.run_action
+        tap_action = self.tap_action
+
+        def handle_scrollbar_report(data):
+            scrollbar_state = data[scrollbar_offset]
+            previous_scrollbar_state = self.previous_scrollbar_state
+
+            if scrollbar_state:
+                if previous_scrollbar_state:
+                    if scrollbar_state > previous_scrollbar_state:
+                        tap_action(increase_action)
+                    elif scrollbar_state < previous_scrollbar_state:
+                        tap_action(decrease_action)
+
+                if scrollbar_state != previous_scrollbar_state and level_actions:
+                    tap_action(level_actions[scrollbar_state-1])
+            else:
+                run_action(())
+
+            self.previous_scrollbar_state = scrollbar_state
+
+        return handle_scrollbar_report
+
+    def make_scrollbar_wheel_handler(self, hold_action):
+        # Scrolls with the mouse wheel instead of firing the scrollbar actions. hold_action is held
+        # down while the finger is on the scrollbar, like KEY_LEFTCTRL to zoom instead of scroll
+        scrollbar_offset = self.decoder.scrollbar_offset
+        run_action = self.run_action
+        scroll_wheel = self.scroll_wheel
+
+        def handle_scrollbar_wheel_report(data):
+            scrollbar_state = data[scrollbar_offset]
+            previous_scrollbar_state = self.previous_scrollbar_state
+
+            if scrollbar_state:
+                run_action(hold_action)
+                if previous_scrollbar_state and scrollbar_state != previous_scrollbar_state:
+                    report_time_ns = self.report_time_ns
+                    # Replays have no loop, they call flush_scroll_until between reports instead
+                    if scroll_wheel.add_steps(scrollbar_state - previous_scrollbar_state, report_time_ns):
+                        self.write_scroll(report_time_ns)
+                    elif self.loop and not self.scroll_timer:
+                        self.scroll_timer = self.loop.call_later(
+                            (scroll_wheel.get_flush_time_ns() - report_time_ns) / 1e9,
+                            self.flush_scroll
+                        )
+            else:
+                # Whatever is left of the movement is sent with the finger lifting off
+                if scroll_wheel.pending_steps:
+                    self.write_scroll(self.report_time_ns)
+                self.stop_scrolling()
+                run_action(())
+
+            self.previous_scrollbar_state = scrollbar_state
+
+        return handle_scrollbar_wheel_report
+
+    def write_scroll(self, timestamp_ns):
+        scroll_wheel = self.scroll_wheel
+        scroll_wheel.take(timestamp_ns)
+        if scroll_wheel.hi_res:
+            self.emitter.write_rel(ecodes.REL_WHEEL_HI_RES, scroll_wheel.hi_res)
+        if scroll_wheel.detents:
+            self.emitter.write_rel(ecodes.REL_WHEEL, scroll_wheel.detents)
+
+    def flush_scroll(self):
+        self.scroll_timer = None
+        if self.scroll_wheel and self.scroll_wheel.pending_steps:
+            self.write_scroll(time.monotonic_ns())
+            self.emitter.flush()
+
+    def flush_scroll_until(self, timestamp_ns=None):
+        # Flushes the steps that the scroll timer would have flushed by timestamp_ns, or all of them
+        # if it is None. Replays use this instead of the timer so the steps keep being coalesced
+        scroll_wheel = self.scroll_wheel
+        if not scroll_wheel or not scroll_wheel.pending_steps:
+            return
+
+        flush_time_ns = scroll_wheel.get_flush_time_ns()
+        if timestamp_ns is None or timestamp_ns >= flush_time_ns:
+            self.write_scroll(flush_time_ns)
+            self.emitter.flush()
+
+    def stop_scrolling(self):
+        if self.scroll_timer:
+            self.loop.cancel(self.scroll_timer)
+            self.scroll_timer = None
+
+        if self.scroll_wheel:
+            self.scroll_wheel.reset()
+
+    def build_report_handlers(self):
+        # Map each report ID to the function that handles it. Pen reports without an action name
+        # mean that nothing is happening so any actions get reset
+        compiled_actions = self.compiled_actions
+        report_handlers = dict(
+            (report_id, self.make_pen_handler(compiled_actions.get(action_name, ())))
+            for report_id, action_name in self.decoder.pen_reports.items()
+        )
+
+        report_handlers[self.decoder.tablet_buttons_report] = self.make_tablet_buttons_handler(
+            compiled_actions.get('tablet_buttons', ())
+        )
+        if self.scroll_wheel:
+            report_handlers[self.decoder.scrollbar_report] = self.make_scrollbar_wheel_handler(
+                compiled_actions.get('tablet_scrollbar_hold', ())
+            )
+        else:
+            report_handlers[self.decoder.scrollbar_report] = self.make_scrollbar_handler(
+                compiled_actions.get('tablet_scrollbar_increase', ()),
+                compiled_actions.get('tablet_scrollbar_decrease', ()),
+                compiled_actions.get('tablet_scrollbar', ()),
+            )
+
+        return report_handlers
+
+    # PIPELINE ------------------------------------------------------------------------------------
+
+    def create_vpen(self):
+        # A stand-in device lets recordings be replayed on machines without access to uinput
+        if self.options['--fake-uinput']:
+            return FakeUInput()
+
+        pen = self.config['pen']
+
+        # Define the events that will be triggered by the custom xinput device that we will create
+        pen_events = {
+            # Defining a pressure sensitive pen tablet area with 2 stylus buttons and no eraser
+            ecodes.EV_KEY: get_required_ecodes(self.compiled_profiles),
+            ecodes.EV_ABS: [
+                #AbsInfo input: value, min, max, fuzz, flat, resolution
+                (ecodes.ABS_X, AbsInfo(0,0,pen['max_x'],0,0,pen['resolution'])),
+                (ecodes.ABS_Y, AbsInfo(0,0,pen['max_y'],0,0,pen['resolution'])),
+                (ecodes.ABS_PRESSURE, AbsInfo(0,0,pen['max_pressure'],0,0,0)),
+                (ecodes.ABS_TILT_X, AbsInfo(0,0,pen['max_tilt_x'],0,0,0)),
+                (ecodes.ABS_TILT_Y, AbsInfo(0,0,pen['max_tilt_y'],0,0,0)),
+            ],
+        }
+
+        # Only profiles that scroll with the scrollbar need a wheel
+        if self.scroll_wheels:
+            pen_events[ecodes.EV_REL] = [ecodes.REL_WHEEL, ecodes.REL_WHEEL_HI_RES]
+
+        if self.timestamp_events:
+            pen_events[ecodes.EV_MSC] = [ecodes.MSC_TIMESTAMP]
+
+        # Create a virtual pen in /dev/input/ so that it shows up as a XInput device
+        return UInput(events=pen_events, name=self.config['xinput_name'], version=0x3)
+
+    def open_output(self):
+        # The virtual pen lives as long as the driver process. It is kept while the tablet is
+        # unplugged so that the X server doesn't have to probe a new device and the display
+        # mapping survives a reconnect
+        self.output_key_codes = set(get_required_ecodes(self.compiled_profiles))
+        self.output_has_wheel = bool(self.scroll_wheels)
+        self.vpen = self.create_vpen()
+        self.emitter = EventEmitter(self.vpen)
+        self.update_display_transform()
+
+    def update_display_transform(self):
+        self.display_transform = None
+        if self.config['display_area']:
+            self.display_transform = build_display_transform(
+                self.config['display_area'],
+                self.config['pen']['max_x'],
+                self.config['pen']['max_y']
+            )
+
+    def close_output(self):
+        self.release_actions()
+        self.vpen.close()
+
+    def reload(self, config, profiles, compiled_profiles):
+        # The virtual pen and the USB connection are kept. Only the parts that depend on the
+        # profiles, the report layout and the display area are rebuilt
+        self.release_actions()
+        display_changed = (config['display'], config['display_area']) != \
+            (self.config['display'], self.config['display_area'])
+        self.config = config
+        self.compiled_profiles = compiled_profiles
+        self.build_profile_settings(profiles)
+
+        # Profiles can add keys or a wheel that the virtual pen was not created with
+        output_reopened = False
+        if (not set(get_required_ecodes(compiled_profiles)) <= self.output_key_codes
+                or self.scroll_wheels and not self.output_has_wheel):
+            self.close_output()
+            self.open_output()
+            output_reopened = True
+        else:
+            self.update_display_transform()
+
+        if display_changed:
+            self.update_display_mapping(output_reopened)
+
+        if self.decoder:
+            self.setup_pipeline(len(self.report_buffer))
+        self.set_profile(config['profile'])
+
+    def setup_pipeline(self, packet_size):
+        # Everything that a report passes through on its way from the USB to uinput. Reports are
+        # read straight into the decoder's buffer instead of a new array every time
+        self.decoder = ReportDecoder(self.config['report_layout'], packet_size)
+        self.report_buffer = self.decoder.buffer
+        self.report_view = memoryview(self.report_buffer)
+        self.report_id_offset = self.decoder.report_id_offset
+        self.print_usb_data = bool(self.diagnostics and self.options['--print-usb-data'])
+
+        self.report_handlers = self.build_report_handlers()
+
+    def process_report(self, length):
+        # Handle the report that is currently in report_buffer
+        report_buffer = self.report_buffer
+        report_id = report_buffer[self.report_id_offset]
+        self.report_counts[report_id] += 1
+        handler = self.report_handlers.get(report_id)
+        if handler:
+            handler(report_buffer)
+
+        latency = self.latency
+        if latency:
+            latency.mark_handled()
+
+        # Only frames that have events in them get written, so only those get a timestamp
+        if self.timestamp_events and self.emitter.queued:
+            self.emitter.write_msc(ecodes.MSC_TIMESTAMP, get_event_timestamp(self.report_time_ns))
+
+        # Dispatch the evdev events for this report with a single write
+        self.emitter.flush()
+
+        if latency:
+            latency.finish()
+
+        if self.print_usb_data:
+            self.diagnostics.push(self.message_prefix, format_usb_data, report_buffer[:length])
+
+    def print_emitter_stats(self):
+        self.print_message(
+            'uinput events written: {events_written}, suppressed: {events_suppressed}, '
+            'key events: {key_events_written}, '
+            'frames written: {frames_written}, suppressed: {frames_suppressed}'.format(
+                **self.emitter.get_stats()
+            )
+        )
+
+    def get_stats(self):
+        stats = {
+            'xinput_name': self.config['xinput_name'],
+            'profile': self.profile,
+            'attached': bool(self.usb_device),
+            'reports': self.reports_processed,
+            'reports_by_id': dict(
+                (str(report_id), count) for report_id, count in enumerate(self.report_counts) if count
+            ),
+            'read_timeouts': self.read_timeouts,
+            'usb_errors': self.usb_errors,
+            'attaches': self.attach_count,
+            'attach_failures': self.attach_failures,
+            'disconnects': self.disconnect_count,
+            'actions': self.actions_fired,
+            'idle': self.idle,
+            'idle_entries': self.idle_entries,
+            'emitter': self.emitter.get_stats(),
+        }
+
+        if self.jitter:
+            stats['report_interval'] = self.jitter.get_stats()
+
+        return stats
+
+    # DISPLAY MAPPING -----------------------------------------------------------------------------
+
+    def handle_display_mapped(self, mapped):
+        if mapped:
+            self.print_message('Driver output mapped to {}'.format(self.config['display']))
+        else:
+            self.print_message('Driver output could not be mapped to {}'.format(self.config['display']))
+
+    def setup_display_mapping(self):
+        if self.config['display_area']:
+            self.print_message('Driver output mapped to the display area by the driver')
+            return
+
+        if not self.config['display']:
+            self.print_message('Driver output not mapped to any display')
+            return
+
+        # The mapping gets applied when udev reports the virtual pen's input node
+        self.xinput_mapper = XinputMapper(
+            self.loop,
+            self.config['xinput_name'],
+            self.config['display'],
+            self.handle_display_mapped
+        )
+
+    def update_display_mapping(self, output_reopened):
+        if self.config['display_area'] or not self.config['display']:
+            self.xinput_mapper = None
+            self.setup_display_mapping()
+            return
+
+        if not self.xinput_mapper:
+            self.setup_display_mapping()
+
+        # A virtual pen that was opened again gets mapped when udev reports its new input node.
+        # The one that was kept has to be mapped right away
+        if output_reopened:
+            self.xinput_mapper.display = self.config['display']
+        else:
+            self.xinput_mapper.map_to_display(self.config['display'])
+
+    # USB -----------------------------------------------------------------------------------------
+
+    def matches(self, vendor_id, product_id):
+        return vendor_id == self.config['vendor_id'] and product_id == self.config['product_id']
+
+    def get_usb_address(self):
+        return (self.usb_device.bus, self.usb_device.address)
+
+    def find_usb_device(self, claimed_addresses):
+        # Several tablets of the same model share the same IDs, so skip the ones that other
+        # tablets already use and tell the rest apart by their serial if the config gives one
+        for dev in usb.core.find(
+            find_all=True,
+            idVendor=self.config['vendor_id'],
+            idProduct=self.config['product_id']
+        ):
+            if (dev.bus, dev.address) in claimed_addresses:
+                continue
+
+            if self.config['serial']:
+                try:
+                    serial = usb.util.get_string(dev, dev.iSerialNumber) if dev.iSerialNumber else None
+                except (usb.core.USBError, ValueError):
+                    serial = None
+                if serial != self.config['serial']:
+                    continue
+
+            return dev
+
+        return None
+
+    def open_tablet(self, claimed_addresses):
+        # Try to get a reference to the USB we need
+        dev = self.find_usb_device(claimed_addresses)
+        if not dev:
+            raise Exception("Could not find device. The device may be unavailable or already open")
+
+        # Forcefully claim the interface from any other script that might have been using it
+        for cfg in dev:
+            for interface in cfg:
+                if dev.is_kernel_driver_active(interface.index):
+                    dev.detach_kernel_driver(interface.index)
+                    usb.util.claim_interface(dev, interface.index)
+                    self.print_message("grabbed interface {}".format(interface.index))
+
+        # The string descriptors need to be read or otherwise the tablet may not be in the correct
+        # mode and no output might be seen from the first endpoint after a tablet reboot
+        self.tablet_info = probe_tablet(
+            dev,
+            self.options['--probe-cache'],
+            self.options['--full-probe'],
+            self.quiet
+        )
+
+        # Seems like we need to try and read atleast once from the second endpoint on the device
+        # or else the output from the first endpoint may get blocked on a tablet reboot
+        try:
+            endpoint_1 = dev[0][(1,0)][0]
+            data = dev.read(endpoint_1.bEndpointAddress,endpoint_1.wMaxPacketSize)
+        except usb.core.USBError as e:
+            # Timing out is fine, all that matters is that the read was requested
+            if e.errno != errno.ETIMEDOUT:
+                self.count_usb_error(e)
+
+        return dev
+
+    def attach(self, claimed_addresses=()):
+        attach_start = time.monotonic()
+        self.waiting_for_first_report_since = attach_start
+
+        try:
+            dev = self.open_tablet(claimed_addresses)
+        except Exception as e:
+            self.attach_failures += 1
+            self.print_message(str(e))
+            return
+
+        # Get a reference to the end that the tablet's output will be read from
+        self.usb_endpoint = dev[0][(0,0)][0]
+
+        self.setup_pipeline(self.usb_endpoint.wMaxPacketSize)
+
+        self.usb_device = dev
+        self.attach_count += 1
+
+        async_transfers = int(self.options['--async-transfers'])
+        if not async_transfers:
+            # Blocking reads have no file descriptor to wait on so they get polled by the loop
+            self.loop.add_poller(self.read)
+            self.print_attach_time(attach_start)
+            return
+
+        # libusb1 needs to claim the interface itself so pyusb has to let go of it first
+        usb.util.dispose_resources(dev)
+        try:
+            self.async_reader = AsyncTabletReader(
+                self.loop,
+                dev.bus,
+                dev.address,
+                dev[0][(0,0)].bInterfaceNumber,
+                self.usb_endpoint.bEndpointAddress,
+                self.usb_endpoint.wMaxPacketSize,
+                async_transfers,
+                self.handle_async_report,
+                self.handle_async_disconnect,
+                self.count_usb_error,
+            )
+        except Exception as e:
+            # pyusb has already let go of the tablet and no poller was added, so there is nothing
+            # else to undo
+            self.attach_failures += 1
+            self.usb_device = None
+            self.print_message(str(e))
+            return
+
+        self.print_attach_time(attach_start)
+
+    def print_first_report_time(self):
+        self.print_message('First report received {:.1f} ms after the tablet was found'.format(
+            (time.monotonic() - self.waiting_for_first_report_since) * 1000
+        ))
+        self.waiting_for_first_report_since = None
+
+    def print_attach_time(self, attach_start):
+        self.print_message('Tablet attached in {:.1f} ms'.format((time.monotonic() - attach_start) * 1000))
+
+    def detach(self):
+        if self.async_reader:
+            self.async_reader.close()
+            self.async_reader = None
+        else:
+            # A tablet whose attach failed half way was never polled
+            if self.read in self.loop.pollers:
+                self.loop.remove_poller(self.read)
+            usb.util.dispose_resources(self.usb_device)
+        self.usb_device = None
+        self.enter_idle()
+
+        self.release_actions()
+        self.print_emitter_stats()
+
+    # IDLE MODE -----------------------------------------------------------------------------------
+
+    def resume(self):
+        # The first report after being idle switches back to short reads
+        self.idle = False
+        self.idle_tracker.set_active(self, True)
+        self.idle_timer = self.loop.call_later(IDLE_AFTER_LEAVE_S, self.check_idle)
+
+    def check_idle(self):
+        self.idle_timer = None
+
+        # report_buffer still holds the last report. The pen is in range for as long as the
+        # tablet keeps sending pen reports
+        if self.report_buffer[self.report_id_offset] in self.decoder.pen_reports:
+            idle_after_ns = IDLE_AFTER_S * 1e9
+        else:
+            idle_after_ns = IDLE_AFTER_LEAVE_S * 1e9
+
+        remaining_ns = self.report_time_ns + idle_after_ns - time.monotonic_ns()
+        if remaining_ns > 0:
+            # Checked again soon enough to notice the pen leaving in the meantime
+            self.idle_timer = self.loop.call_later(min(remaining_ns / 1e9, IDLE_AFTER_LEAVE_S), self.check_idle)
+            return
+
+        self.enter_idle()
+        self.idle_entries += 1
+
+    def enter_idle(self):
+        if self.idle_timer:
+            self.loop.cancel(self.idle_timer)
+            self.idle_timer = None
+
+        self.idle = True
+        self.idle_tracker.set_active(self, False)
+
+    def receive_report(self, length):
+        # A report from the tablet has just been put into report_buffer
+        self.report_time_ns = time.monotonic_ns()
+        if self.idle:
+            self.resume()
+        if self.latency:
+            self.latency.start(self.report_time_ns)
+        if self.jitter:
+            self.jitter.record(self.report_time_ns)
+
+        if self.waiting_for_first_report_since:
+            self.print_first_report_time()
+
+        if self.recorder:
+            self.recorder.write(self.report_buffer, length, self.report_time_ns)
+
+        self.reports_processed += 1
+        self.process_report(length)
+
+    def read(self):
+        loop = self.loop
+        if len(loop.pollers) > 1:
+            timeout = SHARED_READ_TIMEOUT_MS
+        elif self.idle_tracker.all_idle:
+            timeout = IDLE_READ_TIMEOUT_MS
+        else:
+            timeout = USB_READ_TIMEOUT_MS
+
+        # Timers like key repeat and the scroll wheel frames still have to run on time. A timeout
+        # of 0 would wait forever
+        timer_timeout = loop.get_timer_timeout()
+        if timer_timeout is not None:
+            timeout = max(min(timeout, int(timer_timeout * 1000)), 1)
+
+        try:
+            # Read data from the USB
+            length = self.usb_device.read(self.usb_endpoint.bEndpointAddress, self.report_buffer, timeout)
+            self.receive_report(length)
+
+        except usb.core.USBError as e:
+            if e.errno == errno.ETIMEDOUT:
+                # No report came in during this cycle. Thats ok
+                self.read_timeouts += 1
+            elif e.errno == errno.ENODEV:
+                self.disconnect_count += 1
+                self.detach()
+                self.print_message('Device has been disconnected')
+            else:
+                self.count_usb_error(e)
+
+    def count_usb_error(self, error):
+        # error is either a USBError or the name of an errno
+        if isinstance(error, str):
+            name = error
+        else:
+            name = errno.errorcode.get(error.errno, 'unknown')
+
+        if name == 'ETIMEDOUT':
+            self.read_timeouts += 1
+            return
+
+        # Only the first error of every kind is printed so a flaky cable can't flood the output
+        if name not in self.usb_errors:
+            self.usb_errors[name] = 0
+            self.print_message('USB error: {}'.format(error))
+        self.usb_errors[name] += 1
+
+    def handle_async_report(self, transfer_view, length):
+        self.report_view[:length] = transfer_view[:length]
+        self.receive_report(length)
+
+    def handle_async_disconnect(self):
+        if not self.usb_device:
+            return
+
+        self.disconnect_count += 1
+        self.detach()
+        self.print_message('Device has been disconnected')
@@ -0,0 +1,119 @@
+from __future__ import print_function
+import sys
+import threading
+
+# CONSTANTS ---------------------------------------------------------------------------------------
+
+# Lines that can wait to be written. Has to be a power of 2
+DIAGNOSTICS_CAPACITY = 1024
+
+# How often the writer thread wakes up to write the waiting lines
+WRITE_INTERVAL_S = 0.05
+
+# FORMATTERS --------------------------------------------------------------------------------------
+
+def format_usb_data(data, spacing=6):
+    return ''.join(str(element).ljust(spacing) for element in data) + '\n'
+
+def format_calculated_data(data):
+    return 'X {} Y {} PRESS {}          \r'.format(*data)
+
+# WRITER ------------------------------------------------------------------------------------------
+
+class DiagnosticsWriter(object):
+    """
+    Keeps diagnostic output off the report path. The report path only stores the raw values in a
+    ring buffer and a background thread formats and writes them, at most max_lines_per_second of
+    them. When the ring is full new lines are dropped and counted instead of making the report
+    path wait for the terminal. The ring has a single producer (the event loop thread) and a
+    single consumer (the writer thread) that each only move their own index, so no lock is needed
+    """
+
+    def __init__(self, max_lines_per_second, output=None, capacity=DIAGNOSTICS_CAPACITY):
+        self.output = output or sys.stdout
+        self.capacity = capacity
+        self.mask = capacity - 1
+
+        # Three parallel rings so that pushing a line doesn't have to build a tuple for it
+        self.prefixes = [None] * capacity
+        self.formatters = [None] * capacity
+        self.payloads = [None] * capacity
+        self.write_index = 0
+        self.read_index = 0
+
+        self.lines_per_write = max(1, int(max_lines_per_second * WRITE_INTERVAL_S))
+        self.lines_written = 0
+        self.lines_dropped = 0
+        self.reported_dropped = 0
+
+        self.stop_event = threading.Event()
+        self.thread = threading.Thread(target=self.run, name='kamvas-diagnostics')
+        self.thread.daemon = True
+        self.thread.start()
+
+    def push(self, prefix, formatter, payload):
+        # Only called from the event loop thread
+        write_index = self.write_index
+        if write_index - self.read_index > self.mask:
+            self.lines_dropped += 1
+            return
+
+        slot = write_index & self.mask
+        self.prefixes[slot] = prefix
+        self.formatters[slot] = formatter
+        self.payloads[slot] = payload
+        self.write_index = write_index + 1
+
+    def write_pending(self, limit):
+        read_index = self.read_index
+        end_index = min(self.write_index, read_index + limit)
+
+        lines = []
+        for index in range(read_index, end_index):
+            slot = index & self.mask
+            lines.append(self.prefixes[slot] + self.formatters[slot](self.payloads[slot]))
+            self.payloads[slot] = None
+        # The slots can only be reused once they have been read
+        self.read_index = end_index
+
+        lines_dropped = self.lines_dropped
+        if lines_dropped != self.reported_dropped:
+            lines.append('[{} diagnostic lines dropped]\n'.format(lines_dropped - self.reported_dropped))
+            self.reported_dropped = lines_dropped
+
+        if not lines:
+            return
+
+        try:
+            self.output.write(''.join(lines))
+            self.output.flush()
+        except (IOError, OSError, ValueError):
+            # Stdout went away. Keep draining so the report path doesn't fill up the ring
+            pass
+        self.lines_written += end_index - read_index
+
+    def run(self):
+        while not self.stop_event.wait(WRITE_INTERVAL_S):
+            self.write_pending(self.lines_per_write)
+
+    def get_stats(self):
+        return {
+            'lines_written': self.lines_written,
+            'lines_dropped': self.lines_dropped,
+            'lines_waiting': self.write_index - self.read_index,
+        }
+
+    def close(self):
+        if self.stop_event.is_set():
+            return
+
+        self.stop_event.set()
+        self.thread.join()
+
+        # Whatever is still waiting gets written without the rate limit
+        self.write_pending(self.capacity)
+        if self.lines_dropped:
+            print('\n{} of {} diagnostic lines were dropped to keep up with the tablet'.format(
+                self.lines_dropped,
+                self.lines_written + self.lines_dropped,
+            ), file=self.output)
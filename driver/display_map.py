@@ -0,0 +1,111 @@
+import subprocess
+
+# CONSTANTS ---------------------------------------------------------------------------------------
+
+# The X server picks up the new input device from udev at about the same time as the driver does,
+# so the first xinput call can come too early. Retry a few times with a growing delay
+MAP_ATTEMPTS = 6
+FIRST_RETRY_DELAY = 0.1
+PROCESS_POLL_INTERVAL = 0.05
+
+# Fixed point precision used by the display area transform
+TRANSFORM_SHIFT = 16
+
+# XINPUT MAPPING ----------------------------------------------------------------------------------
+
+class XinputMapper(object):
+    """
+    Maps the virtual pen to a display with `xinput map-to-output` as soon as udev reports its
+    input node, instead of polling `xinput list`. xinput runs in the background and is checked
+    on the event loop's timers so the loop never blocks on it
+    """
+
+    def __init__(self, loop, xinput_name, display, on_done):
+        self.loop = loop
+        self.xinput_name = xinput_name
+        self.display = display
+        self.on_done = on_done
+
+        self.process = None
+        self.attempt = 0
+        self.mapped = False
+        self.remap = False
+
+    def handle_input_event(self, action, device):
+        if action != 'add' or self.process or not device.sys_name.startswith('event'):
+            return
+
+        # The event node's parent is the input device that carries the name given to uinput
+        try:
+            name = device.parent.attributes.asstring('name')
+        except (KeyError, AttributeError):
+            return
+
+        if name == self.xinput_name:
+            self.attempt = 0
+            self.run_xinput()
+
+    def map_to_display(self, display):
+        # Maps the virtual pen that already exists to another display
+        self.display = display
+        self.attempt = 0
+        if self.process:
+            # The xinput that is running still uses the old display
+            self.remap = True
+        else:
+            self.run_xinput()
+
+    def run_xinput(self):
+        self.attempt += 1
+        try:
+            self.process = subprocess.Popen(
+                ['xinput', 'map-to-output', self.xinput_name, self.display],
+                stdout=subprocess.DEVNULL,
+                stderr=subprocess.DEVNULL,
+            )
+        except OSError:
+            # xinput is not installed
+            self.process = None
+            self.on_done(False)
+            return
+
+        self.loop.call_later(PROCESS_POLL_INTERVAL, self.check_xinput)
+
+    def check_xinput(self):
+        return_code = self.process.poll()
+        if return_code is None:
+            self.loop.call_later(PROCESS_POLL_INTERVAL, self.check_xinput)
+            return
+
+        self.process = None
+        if self.remap:
+            self.remap = False
+            self.run_xinput()
+        elif return_code == 0:
+            self.mapped = True
+            self.on_done(True)
+        elif self.attempt < MAP_ATTEMPTS:
+            self.loop.call_later(FIRST_RETRY_DELAY * 2 ** (self.attempt - 1), self.run_xinput)
+        else:
+            self.on_done(False)
+
+# DISPLAY AREA TRANSFORM --------------------------------------------------------------------------
+
+def build_display_transform(display_area, max_x, max_y):
+    """
+    Returns (scale_x, offset_x, scale_y, offset_y) so that
+    (value * scale >> TRANSFORM_SHIFT) + offset maps the full pen range onto the given area of the
+    desktop. display_area looks like {"desktop": [width, height], "area": [x, y, width, height]}
+    in pixels. The X server maps the axis ranges to the whole desktop, so this has the same effect
+    as `xinput map-to-output` without needing xinput at all
+    """
+
+    desktop_width, desktop_height = display_area['desktop']
+    area_x, area_y, area_width, area_height = display_area['area']
+
+    return (
+        int(round(float(area_width) / desktop_width * (1 << TRANSFORM_SHIFT))),
+        int(round(float(area_x) / desktop_width * max_x)),
+        int(round(float(area_height) / desktop_height * (1 << TRANSFORM_SHIFT))),
+        int(round(float(area_y) / desktop_height * max_y)),
+    )
@@ -0,0 +1,102 @@
+import os
+import struct
+
+from evdev import ecodes
+
+# CONSTANTS ---------------------------------------------------------------------------------------
+
+# struct input_event from linux/input.h: struct timeval time, __u16 type, __u16 code, __s32 value
+# The kernel stamps uinput events itself so the time fields are always left at 0
+INPUT_EVENT = struct.Struct('llHHi')
+
+# The most events that get queued before a frame is written out. A pen report produces 5 axes
+# plus a handful of key events so this is never reached in practice
+MAX_FRAME_EVENTS = 64
+
+# EMITTER -----------------------------------------------------------------------------------------
+
+class EventEmitter(object):
+    """
+    Queues the events for one report and writes them to the uinput device with a single write
+    call when the frame is flushed. Axis values that have not changed since they were last sent
+    are dropped because evdev would discard them anyway.
+    """
+
+    def __init__(self, uinput):
+        self.uinput = uinput
+        self.buffer = bytearray(INPUT_EVENT.size * (MAX_FRAME_EVENTS + 1))
+        self.buffer_view = memoryview(self.buffer)
+        self.queued = 0
+
+        # Last value sent for every ABS_* code. None means it has never been sent
+        self.axis_state = [None] * (ecodes.ABS_MAX + 1)
+
+        self.events_written = 0
+        self.events_suppressed = 0
+        self.key_events_written = 0
+        self.frames_written = 0
+        self.frames_suppressed = 0
+
+    def write_abs(self, code, value):
+        if self.axis_state[code] == value:
+            self.events_suppressed += 1
+            return
+
+        self.axis_state[code] = value
+        self.queue(ecodes.EV_ABS, code, value)
+
+    def write_rel(self, code, value):
+        self.queue(ecodes.EV_REL, code, value)
+
+    def write_msc(self, code, value):
+        self.queue(ecodes.EV_MSC, code, value)
+
+    def write_key(self, code, value):
+        self.key_events_written += 1
+        self.queue(ecodes.EV_KEY, code, value)
+
+    def queue(self, event_type, code, value):
+        if self.queued == MAX_FRAME_EVENTS:
+            self.write_queued()
+
+        INPUT_EVENT.pack_into(self.buffer, self.queued * INPUT_EVENT.size, 0, 0, event_type, code, value)
+        self.queued += 1
+
+    def write_queued(self):
+        os.write(self.uinput.fd, self.buffer_view[:self.queued * INPUT_EVENT.size])
+        self.events_written += self.queued
+        self.queued = 0
+
+    def flush(self):
+        # Nothing changed in this report so there is no need to wake up the kernel at all
+        if not self.queued:
+            self.frames_suppressed += 1
+            return
+
+        INPUT_EVENT.pack_into(
+            self.buffer, self.queued * INPUT_EVENT.size, 0, 0, ecodes.EV_SYN, ecodes.SYN_REPORT, 0
+        )
+        self.queued += 1
+        self.write_queued()
+        self.frames_written += 1
+
+    def get_stats(self):
+        return {
+            'events_written': self.events_written,
+            'events_suppressed': self.events_suppressed,
+            'key_events_written': self.key_events_written,
+            'frames_written': self.frames_written,
+            'frames_suppressed': self.frames_suppressed,
+        }
+
+class FakeUInput(object):
+    """
+    Stand-in for evdev.UInput that throws away everything written to it. Used when replaying
+    recordings on machines without uinput access
+    """
+
+    def __init__(self):
+        self.fd = os.open(os.devnull, os.O_WRONLY)
+
+    def close(self):
+        os.close(self.fd)
@@ -0,0 +1,205 @@
+from __future__ import print_function
+import csv
+import time
+import select
+import fcntl
+import struct
+from collections import Counter
+
+from evdev import ecodes, categorize
+
+# CONSTANTS ---------------------------------------------------------------------------------------
+
+# _IOW('E', 0xa0, int) from linux/input.h. Makes evdev stamp the events of this file descriptor
+# with the given clock instead of CLOCK_REALTIME
+EVIOCSCLOCKID = 0x400445a0
+CLOCK_MONOTONIC = 1
+
+# MSC_TIMESTAMP values are microseconds that wrap around at 32 bits
+TIMESTAMP_WRAP = 1 << 32
+
+# Frames further apart than this are pauses in the input, like the pen being lifted, so they are
+# left out of the interval and jitter figures
+MAX_FRAME_INTERVAL_US = 100000
+
+PERCENTILES = (50, 90, 99)
+
+CSV_COLUMNS = ('time_us', 'interval_us', 'events', 'latency_us')
+
+# HELPERS -----------------------------------------------------------------------------------------
+
+def set_monotonic_clock(device):
+    # The driver stamps its frames with CLOCK_MONOTONIC so the kernel's timestamps have to use the
+    # same clock for the latency to mean anything
+    fcntl.ioctl(device.fd, EVIOCSCLOCKID, struct.pack('i', CLOCK_MONOTONIC))
+
+def percentile(sorted_values, percent):
+    if not sorted_values:
+        return 0
+    index = int(round(percent / 100.0 * (len(sorted_values) - 1)))
+    return sorted_values[index]
+
+def get_type_name(event_type):
+    return ecodes.EV.get(event_type, str(event_type))
+
+# ANALYZER ----------------------------------------------------------------------------------------
+
+class EvdevAnalyzer(object):
+    """
+    Collects statistics about the events of an input device: how many events of every type
+    arrive per second, how far apart the SYN_REPORT frames are and how much that spacing varies,
+    and how many events each frame holds. When the driver is started with --timestamp-events
+    every frame carries an MSC_TIMESTAMP with the time the USB report was read, which gives the
+    latency from the driver reading the report to evdev delivering its events
+    """
+
+    def __init__(self, csv_path=None):
+        self.type_counts = Counter()
+        self.frame_sizes = []
+        self.frame_intervals = []
+        self.interval_jitter = []
+        self.latencies = []
+
+        self.first_time_us = None
+        self.last_time_us = None
+        self.frame_events = 0
+        self.frame_timestamp = None
+        self.previous_frame_us = None
+        self.previous_interval = None
+
+        self.csv_file = None
+        self.csv_writer = None
+        if csv_path:
+            self.csv_file = open(csv_path, 'w')
+            self.csv_writer = csv.writer(self.csv_file)
+            self.csv_writer.writerow(CSV_COLUMNS)
+
+    def add_event(self, event):
+        time_us = event.sec * 1000000 + event.usec
+        if self.first_time_us is None:
+            self.first_time_us = time_us
+        self.last_time_us = time_us
+        self.type_counts[event.type] += 1
+
+        if event.type == ecodes.EV_MSC and event.code == ecodes.MSC_TIMESTAMP:
+            self.frame_timestamp = event.value % TIMESTAMP_WRAP
+
+        if event.type != ecodes.EV_SYN:
+            self.frame_events += 1
+            return
+
+        if event.code == ecodes.SYN_REPORT:
+            self.end_frame(time_us)
+
+    def end_frame(self, time_us):
+        self.frame_sizes.append(self.frame_events)
+
+        interval = None
+        if self.previous_frame_us is not None and time_us - self.previous_frame_us <= MAX_FRAME_INTERVAL_US:
+            interval = time_us - self.previous_frame_us
+            self.frame_intervals.append(interval)
+            if self.previous_interval is not None:
+                self.interval_jitter.append(abs(interval - self.previous_interval))
+        self.previous_interval = interval
+        self.previous_frame_us = time_us
+
+        latency = None
+        if self.frame_timestamp is not None:
+            latency = (time_us - self.frame_timestamp) % TIMESTAMP_WRAP
+            self.latencies.append(latency)
+
+        if self.csv_writer:
+            self.csv_writer.writerow((time_us, interval, self.frame_events, latency))
+
+        self.frame_events = 0
+        self.frame_timestamp = None
+
+    def get_duration(self):
+        if self.first_time_us is None:
+            return 0.0
+        return (self.last_time_us - self.first_time_us) / 1e6
+
+    def get_rate_rows(self):
+        duration = self.get_duration()
+        rows = []
+        for event_type, count in sorted(self.type_counts.items()):
+            rows.append([get_type_name(event_type), count, count / duration if duration else 0.0])
+        rows.append(['frames', len(self.frame_sizes), len(self.frame_sizes) / duration if duration else 0.0])
+        return rows
+
+    def get_distribution_rows(self):
+        rows = []
+        for name, values in (
+            ('frame interval us', self.frame_intervals),
+            ('interval jitter us', self.interval_jitter),
+            ('events per frame', self.frame_sizes),
+            ('driver to evdev latency us', self.latencies),
+        ):
+            if not values:
+                continue
+            values = sorted(values)
+            rows.append(
+                [name, len(values), values[0]]
+                + [percentile(values, percent) for percent in PERCENTILES]
+                + [values[-1]]
+            )
+        return rows
+
+    def format_summary(self):
+        from tabulate import tabulate
+
+        return '{}\n\n{}'.format(
+            tabulate(
+                self.get_rate_rows(),
+                headers=['events over {:.1f} s'.format(self.get_duration()), 'count', 'per second'],
+                floatfmt='.1f'
+            ),
+            tabulate(
+                self.get_distribution_rows(),
+                headers=['', 'count', 'min'] + ['p{}'.format(percent) for percent in PERCENTILES] + ['max']
+            ),
+        )
+
+    def close(self):
+        if self.csv_file:
+            self.csv_file.close()
+
+# MAIN --------------------------------------------------------------------------------------------
+
+def analyze_device(device, duration=None, csv_path=None, print_keys=True):
+    # Reads events from device until duration seconds have passed or the user presses Ctrl+C and
+    # returns the analyzer with everything it saw
+    try:
+        set_monotonic_clock(device)
+    except (IOError, OSError) as e:
+        print('Could not switch the event clock to CLOCK_MONOTONIC, latencies will be wrong: {}'.format(e))
+
+    analyzer = EvdevAnalyzer(csv_path)
+    end_time = time.monotonic() + duration if duration else None
+    try:
+        while True:
+            # Waits for events with a timeout so that a device that stays silent still stops on time
+            timeout = None
+            if end_time:
+                timeout = end_time - time.monotonic()
+                if timeout <= 0:
+                    break
+
+            if not select.select([device.fd], [], [], timeout)[0]:
+                continue
+
+            try:
+                events = list(device.read())
+            except BlockingIOError:
+                continue
+
+            for event in events:
+                analyzer.add_event(event)
+                if print_keys and event.type == ecodes.EV_KEY:
+                    print(categorize(event))
+    except KeyboardInterrupt:
+        pass
+    finally:
+        analyzer.close()
+
+    return analyzer
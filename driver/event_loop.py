@@ -0,0 +1,129 @@
+import os
+import heapq
+import itertools
+import selectors
+import time
+
+# EVENT LOOP --------------------------------------------------------------------------------------
+
+class EventLoop(object):
+    """
+    Single threaded loop that waits on file descriptors (the udev monitor, the control pipe and
+    anything else that gets registered) and runs timers. Pollers can be added for work that has
+    no file descriptor to wait on, like blocking USB reads. While there are any, the file
+    descriptors are only checked without waiting and every poller is called once per iteration,
+    starting with a different one each time so that none of them always goes first
+    """
+
+    def __init__(self):
+        self.selector = selectors.DefaultSelector()
+        self.timers = []
+        self.timer_ids = itertools.count()
+        self.pollers = []
+        self.running = False
+
+        # Every time the loop wakes up, for the idle mode statistics
+        self.iterations = 0
+
+        # Writing to the control pipe wakes the loop up from any thread or signal handler
+        self.control_read, self.control_write = os.pipe()
+        os.set_blocking(self.control_read, False)
+        os.set_blocking(self.control_write, False)
+        self.add_reader(self.control_read, self.handle_control)
+
+    def add_reader(self, fd, callback):
+        self.add_watch(fd, selectors.EVENT_READ, callback)
+
+    def add_watch(self, fd, events, callback):
+        # events is a combination of selectors.EVENT_READ and selectors.EVENT_WRITE
+        self.selector.register(fd, events, callback)
+
+    def remove_watch(self, fd):
+        self.selector.unregister(fd)
+
+    def add_poller(self, poller):
+        self.pollers.append(poller)
+
+    def remove_poller(self, poller):
+        self.pollers.remove(poller)
+
+    def call_later(self, delay, callback):
+        # Returns a handle that can be passed to cancel()
+        timer = [time.monotonic() + delay, next(self.timer_ids), callback]
+        heapq.heappush(self.timers, timer)
+        return timer
+
+    def cancel(self, timer):
+        # Cancelled timers stay in the heap and are skipped when they come up
+        timer[2] = None
+
+    def wakeup(self):
+        try:
+            os.write(self.control_write, b'\0')
+        except BlockingIOError:
+            # The pipe is full so the loop is going to wake up anyway
+            pass
+
+    def stop(self, *_):
+        # Safe to call from signal handlers
+        self.running = False
+        self.wakeup()
+
+    def handle_control(self):
+        try:
+            while os.read(self.control_read, 4096):
+                pass
+        except BlockingIOError:
+            pass
+
+    def run_timers(self):
+        now = time.monotonic()
+        while self.timers and self.timers[0][0] <= now:
+            _, _, callback = heapq.heappop(self.timers)
+            if callback:
+                callback()
+
+    def get_timer_timeout(self):
+        # Seconds until the next timer is due or None if there are no timers. Cancelled timers
+        # are dropped first so that they don't cut waits short
+        timers = self.timers
+        while timers and timers[0][2] is None:
+            heapq.heappop(timers)
+
+        if not timers:
+            return None
+
+        return max(timers[0][0] - time.monotonic(), 0)
+
+    def get_timeout(self):
+        if self.pollers:
+            return 0
+
+        return self.get_timer_timeout()
+
+    def run_once(self):
+        self.iterations += 1
+        for key, _ in self.selector.select(self.get_timeout()):
+            key.data()
+
+        self.run_timers()
+
+        pollers = self.pollers
+        if pollers and self.running:
+            # A poller can remove itself or others while this runs
+            for poller in tuple(pollers):
+                if poller in pollers:
+                    poller()
+
+            if len(pollers) > 1:
+                pollers.append(pollers.pop(0))
+
+    def run(self):
+        self.running = True
+        while self.running:
+            self.run_once()
+
+    def close(self):
+        self.selector.close()
+        os.close(self.control_read)
+        os.close(self.control_write)
@@ -0,0 +1,103 @@
+import time
+
+# CONSTANTS ---------------------------------------------------------------------------------------
+
+# A tablet goes idle once the pen hasn't sent a report for this long. The tablet stops sending
+# pen reports when the pen leaves its range
+IDLE_AFTER_S = 2.0
+
+# ...or this long after a report that wasn't a pen report, like the report the tablet sends when
+# the pen leaves its range or a tablet button being let go
+IDLE_AFTER_LEAVE_S = 0.25
+
+PHASES = ('active', 'idle')
+
+# IDLE TRACKER ------------------------------------------------------------------------------------
+
+class IdleTracker(object):
+    """
+    Keeps track of which tablets are active and splits the wakeups of the driver's loop and the
+    CPU time of the driver between the time that any tablet is active and the time that all of
+    them are idle. While all of them are idle, blocking USB reads use long timeouts
+    """
+
+    def __init__(self, loop):
+        self.loop = loop
+        self.active_devices = set()
+        self.all_idle = True
+        # Called with all_idle whenever it changes
+        self.listeners = []
+        self.reset()
+
+    def reset(self):
+        self.resumes = 0
+
+        # Seconds, CPU seconds and loop wakeups of every phase
+        self.totals = dict((phase, [0.0, 0.0, 0]) for phase in PHASES)
+        self.phase_start = self.get_counters()
+
+    def add_listener(self, listener):
+        self.listeners.append(listener)
+
+    def get_counters(self):
+        return (time.monotonic(), time.process_time(), self.loop.iterations)
+
+    def get_phase(self):
+        return 'idle' if self.all_idle else 'active'
+
+    def add_phase_totals(self):
+        counters = self.get_counters()
+        totals = self.totals[self.get_phase()]
+        for index, value in enumerate(counters):
+            totals[index] += value - self.phase_start[index]
+        self.phase_start = counters
+
+    def set_active(self, device, active):
+        if active:
+            self.active_devices.add(device)
+        else:
+            self.active_devices.discard(device)
+
+        all_idle = not self.active_devices
+        if all_idle == self.all_idle:
+            return
+
+        self.add_phase_totals()
+        self.all_idle = all_idle
+        if not all_idle:
+            self.resumes += 1
+
+        for listener in self.listeners:
+            listener(all_idle)
+
+    def get_stats(self):
+        self.add_phase_totals()
+
+        stats = {
+            'phase': self.get_phase(),
+            'resumes': self.resumes,
+        }
+        for phase, (seconds, cpu_seconds, wakeups) in self.totals.items():
+            stats[phase] = {
+                'seconds': seconds,
+                'cpu_seconds': cpu_seconds,
+                'wakeups': wakeups,
+                'wakeups_per_second': wakeups / seconds if seconds else 0.0,
+                'cpu_percent': cpu_seconds * 100 / seconds if seconds else 0.0,
+            }
+
+        return stats
+
+    def format_stats(self):
+        stats = self.get_stats()
+        total_seconds = stats['idle']['seconds'] + stats['active']['seconds']
+        return 'Idle {:.1f}% of {:.0f} s with {:.1f} wakeups/s and {:.2f}% CPU, active with ' \
+            '{:.1f} wakeups/s and {:.2f}% CPU, woke up {} times'.format(
+                stats['idle']['seconds'] * 100 / total_seconds if total_seconds else 0.0,
+                total_seconds,
+                stats['idle']['wakeups_per_second'],
+                stats['idle']['cpu_percent'],
+                stats['active']['wakeups_per_second'],
+                stats['active']['cpu_percent'],
+                stats['resumes'],
+            )
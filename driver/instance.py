@@ -0,0 +1,107 @@
+import os
+import glob
+import time
+import fcntl
+
+# CONSTANTS ---------------------------------------------------------------------------------------
+
+# Can be overridden to run the driver without write access to /run
+RUNTIME_DIR = os.environ.get('KAMVAS_RUNTIME_DIR', '/run/kamvas')
+
+DEFAULT_INSTANCE = 'kamvas'
+
+# `kamvas status` briefly holds a shared lock on the pidfile to check it, so a driver that is
+# starting at that moment tries again for this long before deciding another driver is running
+LOCK_RETRY_S = 0.2
+LOCK_RETRY_INTERVAL_S = 0.01
+
+# HELPERS -----------------------------------------------------------------------------------------
+
+def get_pidfile_path(name):
+    return os.path.join(RUNTIME_DIR, '{}.pid'.format(name))
+
+def get_socket_path(name):
+    return os.path.join(RUNTIME_DIR, '{}.sock'.format(name))
+
+# LOCK --------------------------------------------------------------------------------------------
+
+class InstanceLock(object):
+    """
+    Pidfile that the driver holds an exclusive flock on for as long as it runs. The kernel drops
+    the lock when the process dies, so a leftover file never makes an instance look alive
+    """
+
+    def __init__(self, name):
+        self.name = name
+        self.path = get_pidfile_path(name)
+        self.fd = None
+
+    def acquire(self):
+        if not os.path.isdir(RUNTIME_DIR):
+            os.makedirs(RUNTIME_DIR, 0o755)
+
+        fd = os.open(self.path, os.O_RDWR | os.O_CREAT, 0o644)
+        give_up_time = time.monotonic() + LOCK_RETRY_S
+        while True:
+            try:
+                fcntl.flock(fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+                break
+            except BlockingIOError:
+                if time.monotonic() < give_up_time:
+                    time.sleep(LOCK_RETRY_INTERVAL_S)
+                    continue
+
+            os.close(fd)
+            instance = read_instance(self.name)
+            if instance and instance['pid'] is None:
+                raise Exception('Driver instance "{}" is already starting'.format(self.name))
+            raise Exception('Driver instance "{}" is already running with PID {}'.format(
+                self.name,
+                instance['pid'] if instance else 'unknown'
+            ))
+
+        os.ftruncate(fd, 0)
+        os.write(fd, '{} {}\n'.format(os.getpid(), time.time()).encode())
+        self.fd = fd
+
+    def release(self):
+        # The file is left in place. Removing it could race with another instance that has
+        # already opened it and is waiting for the lock
+        if self.fd is not None:
+            os.close(self.fd)
+            self.fd = None
+
+def read_instance(name):
+    # Returns {'name', 'pid', 'start_time'} if the instance is running, otherwise None. pid and
+    # start_time are None while the driver is starting and hasn't written them yet
+    try:
+        fd = os.open(get_pidfile_path(name), os.O_RDONLY)
+    except (IOError, OSError):
+        return None
+
+    try:
+        try:
+            fcntl.flock(fd, fcntl.LOCK_SH | fcntl.LOCK_NB)
+            # Nobody holds the lock so the driver that wrote the file is gone
+            return None
+        except BlockingIOError:
+            pass
+
+        content = os.read(fd, 256).decode().split()
+    finally:
+        os.close(fd)
+
+    # The driver holds the lock but is still between taking it and writing the file
+    if len(content) < 2:
+        return {'name': name, 'pid': None, 'start_time': None}
+
+    return {'name': name, 'pid': int(content[0]), 'start_time': float(content[1])}
+
+def list_instances():
+    instances = []
+    for path in sorted(glob.glob(os.path.join(RUNTIME_DIR, '*.pid'))):
+        instance = read_instance(os.path.splitext(os.path.basename(path))[0])
+        if instance:
+            instances.append(instance)
+
+    return instances
@@ -1,391 +1,687 @@
 """
 Usage:
-    kamvas_driver <xinput_name> <usb_vendor_id> <usb_product_id> <pen_data> <action_data>
-        [ -r | --print-usb-data ]
-        [ -c | --print-calculated-data ]
-        [ -q | --quiet-mode ]
-        [ -d=<val> | --map-to-display=<val> ]
+    kamvas_driver --config=<file> [ --profile=<val> ] [ options ]
+    kamvas_driver <xinput_name> <usb_vendor_id> <usb_product_id> <pen_data> <action_data> <layout_data>
+        [ options ]
 
 Options:
+    --config=<file>
+        Read the capabilities and report layouts of every
+        tablet and all the action profiles from this YAML
+        config file. The driver serves every tablet in the
+        config's devices list
+    --profile=<val>
+        The action profile from the config file that every
+        tablet starts with. Uses each tablet's default_action
+        if this is not provided
     -r, --print-usb-data
         Prints the raw USB data to stdout
     -c, --print-calculated-data 
         Prints the calculated X, Y and pressure values
+    --print-rate=<val>
+        Most lines per second that are printed by -r and -c.
+        They are printed by a separate thread and the lines
+        that can't keep up are dropped and counted
+        [default: 200]
     -q, --quiet-mode
         Prevent any output to stdout or stderr
     -d=<val>, --map-to-display=<val>
-        Map the driver output to the given display name.
-        By default the driver output will map to all the
-        system displays
+        Map the output of every tablet to the given display
+        name. By default the driver output will map to all
+        the system displays
+    --record=<file>
+        Write every raw USB report of the first tablet along
+        with the time it was read to <file> so that it can be
+        replayed later
+    --replay=<file>
+        Feed the reports recorded in <file> through the first
+        tablet's pipeline instead of reading them from the
+        tablet, then print how many reports were processed
+        per second
+    --replay-realtime
+        Replay the reports with their original timing
+        instead of as fast as possible
+    --key-repeat=<val>
+        Repeat held keyboard keys this many times per second.
+        Key events are otherwise only sent when an action
+        starts or stops and repeating is left to the desktop
+        [default: 0]
+    --key-repeat-delay=<val>
+        Milliseconds that a key is held down before it starts
+        repeating [default: 250]
+    --realtime
+        Run the read loop with a real-time scheduling policy,
+        locked memory and the garbage collector only running
+        while the tablets are idle. Steps that the driver
+        doesn't have the privileges for are skipped. The
+        report interval jitter is printed every 10 seconds
+    --realtime-policy=<val>
+        Real-time scheduling policy, fifo or rr
+        [default: fifo]
+    --realtime-priority=<val>
+        Real-time priority from 1 to 99 [default: 10]
+    --cpus=<val>
+        Pin the driver to these CPUs in real-time mode, like
+        2,3 or 2-5
+    --metrics-file=<file>
+        Write the driver's health counters to <file> in the
+        Prometheus text format every --metrics-interval
+        seconds, for the node exporter's textfile collector
+    --metrics-interval=<val>
+        Seconds between writes of the metrics file
+        [default: 15]
+    --fake-uinput
+        Discard the driver output instead of sending it to
+        a uinput device. Useful for replaying recordings on
+        machines without uinput access
+    --latency-stats=<file>
+        Time every report from the USB read to the uinput
+        write and append p50/p99/p99.9/max latencies for the
+        decode, smooth, action and uinput stages to <file>
+        when the driver receives SIGUSR1 or exits. The lag
+        of a smoothing filter is listed on its own. Use - for
+        stdout
+    --async-transfers=<val>
+        Keep this many asynchronous interrupt transfers queued
+        on the tablet instead of doing one blocking read at a
+        time. Requires the libusb1 python module. 0 uses
+        blocking reads [default: 0]
+    --timestamp-events
+        Add an MSC_TIMESTAMP event to every frame sent to the
+        virtual pen with the time in microseconds that the
+        report was read, so that the delivery latency can be
+        measured with `kamvas -t`
+    --full-probe
+        Request all 255 USB string descriptors from the tablet
+        and refresh the probe cache instead of only requesting
+        the ones known to wake the tablet up
+    --probe-cache=<file>
+        Where the results of probing the tablet are cached
+        [default: /var/cache/kamvas/probe_cache.json]
+    --display-area=<val>
+        JSON object like {"desktop": [3840, 1080], "area":
+        [1920, 0, 1920, 1080]} giving the desktop size and the
+        area of it that the tablet should cover in pixels.
+        The driver scales the pen coordinates itself so xinput
+        is not needed. Takes precedence over --map-to-display
+    --instance=<val>
+        Name of this driver instance. Only one driver can run
+        per name, which is enforced with a locked pidfile in
+        /run/kamvas. One instance drives every tablet in its
+        config's devices list. Separate instances are only
+        needed for separate configs [default: kamvas]
+    --control-socket=<file>
+        Unix socket that accepts the switch-profile,
+        reload-config, stats, metrics and stop commands.
+        Defaults to /run/kamvas/<instance>.sock
 
 Note:
-    <pen_data>, <action_ids> and <action_data> must be 
-    JSON strings defining the capabilities of the pen 
-    and the actions that need to be performed by the 
-    tablet's onboard buttons respectively
+    Without --config, <pen_data>, <action_data> and <layout_data> must be 
+    JSON strings defining the capabilities of the pen,
+    the actions that need to be performed by the 
+    tablet's onboard buttons and the layout of the USB
+    reports sent by the tablet respectively
 """
 
 from __future__ import print_function
-from pprint import pprint
 
 from docopt import docopt
-from evdev import UInput, ecodes, AbsInfo
-from pyudev import Context, Monitor, MonitorObserver
-import usb.core
-import usb.util
 import sys
 import time
-import math
 import json
-import argparse
-import time
-import subprocess
+import signal
+import atexit
+
+from latency import LatencyRecorder
+from realtime import JITTER_PRINT_INTERVAL_S
+from idle import IdleTracker
+from metrics import build_metrics, write_metrics_file
+from diagnostics import DiagnosticsWriter
+from recording import ReportRecorder, read_recording
+from config_loader import load_compiled_config, load_compiled_profiles, get_profile_name, compile_all_profiles
+from config_loader import check_profile_settings
+from device import TabletDevice
 
 # CONSTANTS ---------------------------------------------------------------------------------------
 
-ACTION_SPLIT_CHAR = '+'
+PROCESS_START = time.monotonic()
 
 # GLOBALS -----------------------------------------------------------------------------------------
 
-previous_scrollbar_state = 0
-previous_tablet_btn = 0
-previous_action = ''
+args = None
+
+# One TabletDevice for every tablet that the driver serves
+devices = []
+
+recorder = None
+
+# Only set when --latency-stats is used so the per-report checks stay cheap
+latency = None
+
+# Only set when --print-usb-data or --print-calculated-data is used
+diagnostics = None
+
+control_server = None
+instance_lock = None
+
+# Splits the wakeups and CPU time of the live driver between active and idle tablets
+idle_tracker = None
 
-tablet_info = []
-evdev_is_running = False
+# Only set in real-time mode
+idle_collector = None
+realtime_status = None
+
+# Exceptions that the driver caught and carried on after, by where they happened
+errors = {}
 
 # HELPER FUNCTIONS --------------------------------------------------------------------------------
 
-def get_args():
-    args = docopt(__doc__)
-    
-    args['<usb_vendor_id>'] = int(args['<usb_vendor_id>'])
-    args['<usb_product_id>'] = int(args['<usb_product_id>'])
+def is_quiet():
+    # Errors can happen before the arguments have been parsed
+    if args:
+        return args['--quiet-mode']
+    return '-q' in sys.argv or '--quiet-mode' in sys.argv
+
+def report_error(message):
+    # --quiet-mode keeps stdout and stderr clean, so errors go to the system log instead of being
+    # lost
+    if is_quiet():
+        import syslog
+        syslog.openlog('kamvas_driver', syslog.LOG_PID)
+        for line in message.rstrip().split('\n'):
+            syslog.syslog(syslog.LOG_ERR, line)
+        return
+
+    print(message, file=sys.stderr)
+
+def count_error(where, error):
+    errors[where] = errors.get(where, 0) + 1
+    # Only the first error from every place is reported so that a recurring one can't flood the log
+    if errors[where] == 1:
+        report_error('Error in {}: {}'.format(where, error))
+
+def get_args(argv=None):
+    args = docopt(__doc__, argv)
+
+    if args['--config']:
+        load_config_args(args, load_compiled_config(args['--config'], args['--quiet-mode']))
+        return args
 
     try:
-        args['pen'] = json.loads(args['<pen_data>'])
-    except:
+        pen = json.loads(args['<pen_data>'])
+    except ValueError:
         if not args['--quiet-mode']:
             print('Error while loading <pen_data> as a JSON object')
-        exit()
+        exit(1)
 
     try:
-        args['actions'] = json.loads(args['<action_data>'])
-    except:
+        actions = json.loads(args['<action_data>'])
+    except ValueError:
         if not args['--quiet-mode']:
             print('Error while loading <action_data> as a JSON object')
-        exit()
+        exit(1)
+
+    try:
+        layout = json.loads(args['<layout_data>'])
+    except ValueError:
+        if not args['--quiet-mode']:
+            print('Error while loading <layout_data> as a JSON object')
+        exit(1)
+
+    # Only the one tablet and the one profile that were passed in can be used
+    config = {'actions': {'default': actions}, 'default_action': 'default'}
+    args['profiles'] = config['actions']
+    args['compiled_profiles'] = compile_all_profiles(config['actions'])
+    check_profile_settings(config['actions'])
+    args['devices'] = [get_device_args(args, config, {
+        'name': 'default',
+        'xinput_name': args['<xinput_name>'],
+        'vendor_id': int(args['<usb_vendor_id>']),
+        'product_id': int(args['<usb_product_id>']),
+        'serial': None,
+        'pen': pen,
+        'report_layout': layout,
+        'default_action': 'default',
+        'default_display': None,
+        'display_area': None,
+    })]
 
     return args
 
-def print_raw_data(data, spacing=5):
-    if args['--quiet-mode']:
-        return
+def load_config_args(args, config):
+    # Fill in the same values that would otherwise have been passed in as JSON. The config has
+    # already been validated and its actions turned into key codes by the config compiler
+    args['profiles'] = config['actions']
+    args['compiled_profiles'] = load_compiled_profiles(config['compiled_actions'])
+    args['devices'] = [get_device_args(args, config, device) for device in config['devices']]
+
+def get_device_args(args, config, device):
+    # The command line options apply to every tablet and take precedence over the config
+    device = dict(device)
+    device['profile'] = get_profile_name(config, args['--profile'] or device['default_action'])
+    device['display'] = args['--map-to-display'] or device['default_display']
+    if args['--display-area']:
+        device['display_area'] = json.loads(args['--display-area'])
+
+    return device
+
+def create_devices(loop=None):
+    # Only the first tablet gets recorded because a recording holds the reports of a single tablet
+    return [
+        TabletDevice(
+            device_args,
+            args['profiles'],
+            args['compiled_profiles'],
+            args,
+            loop,
+            latency,
+            recorder if index == 0 else None,
+            diagnostics,
+            idle_tracker
+        )
+        for index, device_args in enumerate(args['devices'])
+    ]
 
-    string = ''
-    for element in data:
-        string = string + str(element) + ' '*(spacing-len(str(element)))
-    print(string)
+def dump_latency_stats(*_):
+    stats = 'Report latency at {}\n{}\n'.format(time.strftime('%Y-%m-%d %H:%M:%S'), latency.format_stats())
 
-def read_tablet_info(device):
-    for bRequest in range(256):
-        try:
-            result = usb.util.get_string(dev, bRequest)
-            tablet_info.append([hex(bRequest), result])
-        except:
-            pass
-
-def run_action(new_action):
-    def execute(action_text, press_type):
-        if not action_text: return
-            
-        if ACTION_SPLIT_CHAR in action_text:
-            actions = action_text.split(ACTION_SPLIT_CHAR)
-            for action in actions:
-                action_code = ecodes.ecodes.get(action, -1)
-                if action_code == -1: return
-                vpen.write(ecodes.EV_KEY, action_code, press_type)
-        else:
-            action_code = ecodes.ecodes.get(action_text, -1)
-            if action_code == -1: return
-            vpen.write(ecodes.EV_KEY, action_code, press_type)
-  
-    global previous_action
- 
-    if new_action == previous_action: 
-        # "hold" the previously pressed action
-        execute(previous_action, 2)
+    if args['--latency-stats'] == '-':
+        if not args['--quiet-mode']:
+            print(stats)
         return
-    else:
-        # Press "up" any previously pressed action
-        execute(previous_action, 0)
-
-    if new_action:
-        # Press "down" the new action
-        execute(new_action, 1)
-
-    previous_action = new_action
-
-def get_required_ecodes():
-    required_ecodes = [
-        'BTN_TOUCH', 
-        'BTN_TOOL_PEN', 
-        'BTN_STYLUS', 
-        'BTN_STYLUS2'
-    ]
-
-    # Get the ecodes for pen buttons
-    for value in args['actions'].values():
-        if type(value) is list:
-            for sub_value in value:
-                if sub_value:
-                    if ACTION_SPLIT_CHAR in sub_value:
-                        required_ecodes.extend(sub_value.split(ACTION_SPLIT_CHAR))
-                    else: 
-                        required_ecodes.append(sub_value)
-        else:
-            if value:
-                if ACTION_SPLIT_CHAR in value:
-                    required_ecodes.extend(value.split(ACTION_SPLIT_CHAR))
-                else: 
-                    required_ecodes.append(value)
 
-    return [
-        ecodes.ecodes[required_ecode] 
-        for required_ecode in required_ecodes
-    ]
+    with open(args['--latency-stats'], 'a') as stats_file:
+        stats_file.write(stats + '\n')
 
 # USB EVENT HANDLERS ------------------------------------------------------------------------------
 
-def run_evdev():
-    # Define the events that will be triggered by the custom xinput device that we will create
-    pen_events = {
-        # Defining a pressure sensitive pen tablet area with 2 stylus buttons and no eraser
-        ecodes.EV_KEY: get_required_ecodes(),
-        ecodes.EV_ABS: [
-            #AbsInfo input: value, min, max, fuzz, flat, resolution
-            (ecodes.ABS_X, AbsInfo(0,0,args['pen']['max_x'],0,0,args['pen']['resolution'])),         
-            (ecodes.ABS_Y, AbsInfo(0,0,args['pen']['max_y'],0,0,args['pen']['resolution'])),
-            (ecodes.ABS_PRESSURE, AbsInfo(0,0,args['pen']['max_pressure'],0,0,0)),
-            (ecodes.ABS_TILT_X, AbsInfo(0,0,args['pen']['max_tilt_x'],0,0,0)),
-            (ecodes.ABS_TILT_Y, AbsInfo(0,0,args['pen']['max_tilt_y'],0,0,0)),
-        ],
-    }
+def attach_device(device):
+    # Tablets of the same model can't tell which USB device is theirs by the IDs alone
+    device.attach(set(other.get_usb_address() for other in devices if other.usb_device))
 
-    # Try to get a reference to the USB we need
-    dev = usb.core.find(idVendor=args['<usb_vendor_id>'], idProduct=args['<usb_product_id>'])
-    if not dev:
-        raise Exception("Could not find device. The device may be unavailable or already open")
-    
-    # Forcefully claim the interface from any other script that might have been using it
-    for cfg in dev:
-        for interface in cfg:
-            if dev.is_kernel_driver_active(interface.index):
-                dev.detach_kernel_driver(interface.index)
-                usb.util.claim_interface(dev, interface.index)
-                if not args['--quiet-mode']:
-                    print("grabbed interface {}".format(interface.index))
-    
-    # The method needs to be called or otherwise the tablet may not be in the correct mode
-    # and no output might be seen from the first endpoint after a tablet reboot
-    read_tablet_info(dev)
-   
-    # Seems like we need to try and read atleast once from the second endpoint on the device
-    # or else the output from the first endpoint may get blocked on a tablet reboot 
-    try:
-        endpoint_1 = dev[0][(1,0)][0]
-        data = dev.read(endpoint_1.bEndpointAddress,endpoint_1.wMaxPacketSize)
-    except: 
-        pass
-
-    # Create a virtual pen in /dev/input/ so that it shows up as a XInput device
-    global vpen
-    vpen = UInput(events=pen_events, name=args['<xinput_name>'], version=0x3)
-    
-    # Get a reference to the end that the tablet's output will be read from 
-    usb_endpoint = dev[0][(0,0)][0]
-
-    xinput_map_to_display()
-
-    # Read the tablet output in an infinite loop
-    while True:
+def handle_udev_events():
+    # Handle everything the monitor has queued up without blocking
+    for udev_device in iter(lambda: monitor.poll(0), None):
         try:
-            # Read data from the USB
-            data = dev.read(usb_endpoint.bEndpointAddress, usb_endpoint.wMaxPacketSize)
-
-            # Only calculate these values if the event is a pen event and not tablet event
-            if data[1] in [128, 129, 130, 131, 132, 133]:
-                # Calculate the values            
-                pen_x = (data[3] << 8) + (data[2])
-                pen_y = (data[5] << 8) + data[4]
-                pen_pressure = (data[7] << 8) + data[6]
-                pen_tilt_x = data[10] >= 128 and (data[10]-256) or data[10]
-                pen_tilt_y = data[11] >= 128 and (data[11]-256) or data[11]
-
-                # Send data to the Xinput device so that cursor responds
-                vpen.write(ecodes.EV_ABS, ecodes.ABS_X, pen_x)
-                vpen.write(ecodes.EV_ABS, ecodes.ABS_Y, pen_y)
-                vpen.write(ecodes.EV_ABS, ecodes.ABS_PRESSURE, pen_pressure)
-                vpen.write(ecodes.EV_ABS, ecodes.ABS_TILT_X, pen_tilt_x)
-                vpen.write(ecodes.EV_ABS, ecodes.ABS_TILT_Y, pen_tilt_y)
-
-                if args['--print-calculated-data'] and not args['--quiet-mode']:
-                    print("X {} Y {} PRESS {}          ".format(
-                        pen_x, 
-                        pen_y, 
-                        pen_pressure, 
-                    ), end='\r')
-
-            # Reset any actions because this code means that nothing is happening
-            if data[1] == 128:
-                run_action('')
-
-            # Pen click
-            if data[1] == 129:
-                run_action(args['actions'].get('pen_touch', ''))
-
-            # Pen button 1
-            if data[1] == 130:
-                run_action(args['actions'].get('pen_button_1', ''))
-
-            # Pen button 1 with pen touch
-            if data[1] == 131:
-                run_action(args['actions'].get('pen_button_1_touch', ''))
-
-            # Pen button 2
-            if data[1] == 132:
-                run_action(args['actions'].get('pen_button_2', ''))
-
-            # Pen button 2 with pen touch
-            if data[1] == 133:
-                run_action(args['actions'].get('pen_button_2_touch', ''))
-
-            # Tablet buttons
-            if data[1] == 224:
-                global previous_tablet_btn
-                if data[4]:
-                    btn_index = int(math.log(data[4],2))
-                    if previous_tablet_btn != data[4] and args['actions'].get('tablet_buttons', ''):
-                        run_action(args['actions']['tablet_buttons'][btn_index])
-                    previous_tablet_btn = btn_index
-                else:
-                    run_action('')
-                    previous_tablet_btn = 0
-
-            # Scrollbar
-            if data[1] == 240:
-                global previous_scrollbar_state
-                scrollbar_state = data[5]
-
-                if scrollbar_state:
-                    if previous_scrollbar_state:
-                        if scrollbar_state > previous_scrollbar_state:
-                            run_action(args['actions'].get('tablet_scrollbar_increase', ''))
-                        elif scrollbar_state < previous_scrollbar_state:
-                            run_action(args['actions'].get('tablet_scrollbar_decrease', ''))
-
-                    if scrollbar_state != previous_scrollbar_state and args['actions'].get('tablet_scrollbar', ''):
-                        run_action(args['actions']['tablet_scrollbar'][scrollbar_state-1])
-                else:
-                    run_action('')
-                    
-                previous_scrollbar_state = scrollbar_state
-
-            # Dispatch the evdev events
-            vpen.syn()
-            
-            if args['--print-usb-data']:
-                print_raw_data(data, 6)
-    
-        except usb.core.USBError as e:
-            if e.args[0] == 19:
-                vpen.close()
-                raise Exception('Device has been disconnected')
-
-            # The usb read probably timed out for this cycle. Thats ok
-            data = None
-
-def handle_usb_event(action, device):
-    # Don't care if it is already running
-    global evdev_is_running
-    if evdev_is_running:
+            handle_udev_event(udev_device)
+        except Exception as e:
+            # One bad event shouldn't take the driver down with it
+            count_error('udev_event', e)
+
+def handle_udev_event(udev_device):
+    if udev_device.subsystem == 'usb':
+        handle_usb_event(udev_device.action, udev_device)
+        return
+
+    for device in devices:
+        if device.xinput_mapper:
+            device.xinput_mapper.handle_input_event(udev_device.action, udev_device)
+
+def handle_usb_event(action, udev_device):
+    if action != 'bind':
         return
 
     # The graphics tablet USB device we are looking for should have the following 2 attributes
     # defined as base 16 numbers
-    product_id = int(device.get('ID_MODEL_ID', '0'), 16)
-    vendor_id = int(device.get('ID_VENDOR_ID', '0'), 16)
+    product_id = int(udev_device.get('ID_MODEL_ID', '0'), 16)
+    vendor_id = int(udev_device.get('ID_VENDOR_ID', '0'), 16)
+
+    for device in devices:
+        # Don't care about tablets that are already attached
+        if device.usb_device or not device.matches(vendor_id, product_id):
+            continue
+
+        device.print_message('USB device detected. Reading data from it')
+        attach_device(device)
+        if device.usb_device:
+            return
+
+def run_replay():
+    # Load the whole recording up front so that file reads don't get counted as processing time
+    reports = list(read_recording(args['--replay']))
+    if not reports:
+        raise Exception('No reports found in {}'.format(args['--replay']))
+
+    device = create_devices()[0]
+    device.open_output()
+    device.setup_pipeline(max(len(data) for _, data in reports))
+    report_view = device.report_view
+    process_report = device.process_report
+
+    start_time = time.perf_counter()
+    for timestamp_ns, data in reports:
+        if args['--replay-realtime']:
+            # Wait until the report would have arrived from the tablet
+            delay = start_time + timestamp_ns / 1e9 - time.perf_counter()
+            if delay > 0:
+                time.sleep(delay)
+
+        device.flush_scroll_until(timestamp_ns)
+
+        if latency:
+            latency.start()
+
+        device.report_time_ns = timestamp_ns
+        length = len(data)
+        report_view[:length] = data
+        process_report(length)
+    device.flush_scroll_until()
+    elapsed = time.perf_counter() - start_time
+
+    device.close_output()
+
+    if not args['--quiet-mode']:
+        print('Replayed {} reports in {:.3f} s ({:.0f} reports/s)'.format(
+            len(reports),
+            elapsed,
+            len(reports) / elapsed if elapsed else float('inf'),
+        ))
+
+        # Rates against the recording's own length so they can be compared between runs
+        duration = reports[-1][0] / 1e9
+        if duration:
+            stats = device.emitter.get_stats()
+            print('Recording is {:.1f} s long: {:.0f} uinput events/s, {:.0f} key events/s'.format(
+                duration,
+                stats['events_written'] / duration,
+                stats['key_events_written'] / duration,
+            ))
+    device.print_emitter_stats()
+
+# CONTROL COMMANDS --------------------------------------------------------------------------------
+
+def get_devices(name=None):
+    if not name:
+        return devices
+
+    for device in devices:
+        if device.name == name:
+            return [device]
+
+    raise Exception('Device "{}" is not defined in the config'.format(name))
+
+def handle_switch_profile(name, device_name=None):
+    if name not in args['compiled_profiles']:
+        raise Exception('Action "{}" is not defined in the config'.format(name))
+
+    selected_devices = get_devices(device_name)
+
+    start = time.perf_counter()
+    for device in selected_devices:
+        device.set_profile(name)
+
+    return {
+        'profile': name,
+        'devices': [device.name for device in selected_devices],
+        'switch_us': (time.perf_counter() - start) * 1e6,
+    }
+
+def handle_reload_config():
+    if not args['--config']:
+        raise Exception('The driver was not started with --config so there is nothing to reload')
+
+    start = time.perf_counter()
+
+    # Compile everything before touching the running state so that a broken config changes nothing
+    config = load_compiled_config(args['--config'], args['--quiet-mode'])
+    new_args = dict(args, **{'--profile': None})
+    load_config_args(new_args, config)
+
+    if [device['name'] for device in new_args['devices']] != [device.name for device in devices]:
+        raise Exception('The list of devices changed. Restart the driver to apply it')
+
+    for device, device_args in zip(devices, new_args['devices']):
+        for key in ('xinput_name', 'vendor_id', 'product_id', 'serial', 'pen'):
+            if device_args[key] != device.config[key]:
+                raise Exception('The {} of device "{}" changed. Restart the driver to apply it'.format(key, device.name))
+
+        # Tablets keep their current profile if it is still there
+        if device.profile in new_args['compiled_profiles']:
+            device_args['profile'] = device.profile
+
+    args.update(new_args)
+    for device, device_args in zip(devices, args['devices']):
+        device.reload(device_args, args['profiles'], args['compiled_profiles'])
+
+    return {
+        'profiles': dict((device.name, device.profile) for device in devices),
+        'reload_us': (time.perf_counter() - start) * 1e6,
+    }
+
+def handle_stats():
+    stats = {
+        'profiles': sorted(args['compiled_profiles']),
+        'uptime_s': time.monotonic() - PROCESS_START,
+        'devices': dict((device.name, device.get_stats()) for device in devices),
+        'idle_mode': idle_tracker.get_stats(),
+    }
+
+    if latency:
+        stats['latency'] = latency.get_stats()
+
+    if diagnostics:
+        stats['diagnostics'] = diagnostics.get_stats()
 
-    if action == 'bind' and product_id == args['<usb_product_id>'] and vendor_id == args['<usb_vendor_id>']:
+    if idle_collector:
+        stats['realtime'] = dict(realtime_status, gc=idle_collector.get_stats())
+
+    return stats
+
+def handle_metrics():
+    return {'text': get_metrics()}
+
+def handle_stop():
+    loop.stop()
+
+def start_control_server():
+    global control_server
+
+    if not args['--control-socket']:
+        args['--control-socket'] = get_socket_path(args['--instance'])
+
+    try:
+        control_server = ControlServer(loop, args['--control-socket'], {
+            'switch-profile': handle_switch_profile,
+            'reload-config': handle_reload_config,
+            'stats': handle_stats,
+            'metrics': handle_metrics,
+            'stop': handle_stop,
+        })
+    except (IOError, OSError) as e:
         if not args['--quiet-mode']:
-            print('USB device detected. Reading data from it')
+            print('Control socket not available at {}: {}'.format(args['--control-socket'], e))
 
-        try:
-            evdev_is_running = True
-            run_evdev()
-        except:
-            if not args['--quiet-mode']:
-                print('Error occured')
-            evdev_is_running = False
-        
-def xinput_map_to_display():
-    if not args['--map-to-display']:
+# INSTANCE LOCK -----------------------------------------------------------------------------------
+
+def lock_instance():
+    global instance_lock
+
+    instance_lock = InstanceLock(args['--instance'])
+    try:
+        instance_lock.acquire()
+    except (IOError, OSError) as e:
+        # Without /run access the driver still works, it just can't be found by `kamvas status`
+        instance_lock = None
         if not args['--quiet-mode']:
-            print('Driver output not mapped to any display')
-        return
+            print('Could not lock the pidfile for instance "{}": {}'.format(args['--instance'], e))
 
-    for i in range(0,10):
-        # Sleep for a second and try to assign the driver output to the default_display defined
-        # in the config
-        time.sleep(0.5)
-
-        process = subprocess.Popen(['xinput', 'list'], shell=True, stdout=subprocess.PIPE)
-        output = str(process.stdout.read())
-        if args['<xinput_name>'] in output:
-            subprocess.Popen([
-                'xinput', 
-                'map-to-output', 
-                args['<xinput_name>'], 
-                args['--map-to-display']
-            ])
+# METRICS -----------------------------------------------------------------------------------------
 
-            if not args['--quiet-mode']:
-                print('Driver output mapped to {}'.format(args['--map-to-display']))
+def get_metrics(up=True):
+    return build_metrics(
+        args['--instance'],
+        time.monotonic() - PROCESS_START,
+        devices,
+        errors,
+        idle_tracker.get_stats(),
+        up
+    )
 
-            return
+def write_metrics(up=True):
+    try:
+        write_metrics_file(args['--metrics-file'], get_metrics(up))
+    except (IOError, OSError) as e:
+        count_error('metrics_file', e)
+
+def write_metrics_periodically():
+    write_metrics()
+    loop.call_later(float(args['--metrics-interval']), write_metrics_periodically)
+
+# REALTIME MODE -----------------------------------------------------------------------------------
+
+def start_realtime():
+    global idle_collector, realtime_status
+
+    from realtime import enable_realtime, parse_cpus, IdleCollector, SCHEDULING_POLICIES
+
+    if args['--realtime-policy'] not in SCHEDULING_POLICIES:
+        raise Exception('Unknown real-time policy "{}". Use {}'.format(
+            args['--realtime-policy'],
+            ' or '.join(sorted(SCHEDULING_POLICIES))
+        ))
+
+    cpus = parse_cpus(args['--cpus']) if args['--cpus'] else None
+    enabled, failed = enable_realtime(args['--realtime-policy'], int(args['--realtime-priority']), cpus)
+
+    # Everything the driver needs has been set up by now, so freezing it keeps the collector
+    # from ever scanning it again
+    idle_collector = IdleCollector(loop, idle_tracker)
+    enabled.append('garbage collection while idle')
+    realtime_status = {'enabled': enabled, 'failed': failed}
 
     if not args['--quiet-mode']:
-        print('Driver output could not be mapped to {}'.format(args['--map-to-display']))
+        print('Real-time mode: {}'.format(', '.join(enabled)))
+        if failed:
+            print('Real-time mode is missing {}'.format(', '.join(failed)))
+
+    loop.call_later(JITTER_PRINT_INTERVAL_S, print_report_jitter)
+
+def print_report_jitter():
+    for device in devices:
+        if device.jitter.histogram.total:
+            device.print_message(device.jitter.format_stats())
+            device.jitter.reset()
+
+    loop.call_later(JITTER_PRINT_INTERVAL_S, print_report_jitter)
 
 # MAIN --------------------------------------------------------------------------------------------
 
+def import_live_modules():
+    # Replays never touch the USB, udev or the control socket so these are only loaded when the
+    # driver reads from real tablets
+    global Context, Monitor, EventLoop, ControlServer, InstanceLock, get_socket_path
+
+    from pyudev import Context, Monitor
+
+    import device
+    device.import_usb_modules()
+
+    from event_loop import EventLoop
+    from control import ControlServer
+    from instance import InstanceLock, get_socket_path
+
 def run_main():
-    global args
+    global args, devices, latency, diagnostics, loop, monitor, recorder, idle_tracker
     args = get_args()
 
-    # Setup the code for monitoring USB events
+    if (args['--print-usb-data'] or args['--print-calculated-data']) and not args['--quiet-mode']:
+        diagnostics = DiagnosticsWriter(int(args['--print-rate']))
+        atexit.register(diagnostics.close)
+
+    if args['--latency-stats']:
+        latency = LatencyRecorder()
+        signal.signal(signal.SIGUSR1, dump_latency_stats)
+        atexit.register(dump_latency_stats)
+
+    if args['--replay']:
+        run_replay()
+        return
+
+    import_live_modules()
+
+    # Raises if another driver with the same instance name is running
+    lock_instance()
+
+    loop = EventLoop()
+    idle_tracker = IdleTracker(loop)
+
+    # Setup the code for monitoring USB and input device events. The monitor's socket is watched
+    # by the same loop that reads the tablets so no extra thread is needed
     context = Context()
     monitor = Monitor.from_netlink(context)
     monitor.filter_by(subsystem='usb')
+    monitor.filter_by(subsystem='input')
+    monitor.start()
+    loop.add_reader(monitor.fileno(), handle_udev_events)
+
+    signal.signal(signal.SIGTERM, loop.stop)
+    signal.signal(signal.SIGINT, loop.stop)
+
+    start_control_server()
+
+    if args['--record']:
+        recorder = ReportRecorder(args['--record'])
+
+    devices = create_devices(loop)
+
+    # The monitor has to be running before the virtual pens are created so that the events for
+    # their input nodes are not missed
+    for device in devices:
+        device.setup_display_mapping()
+        device.open_output()
 
-    # Start monitoring USB events asynchronously
-    observer = MonitorObserver(monitor, handle_usb_event, name='monitor-observer')
-    observer.daemon = False
-    observer.start()
+    if not args['--quiet-mode']:
+        print('Driver output ready {:.0f} ms after start'.format((time.monotonic() - PROCESS_START) * 1000))
+
+    # Try to start the driver. Tablets that are not available yet get attached later by a udev
+    # event
+    for device in devices:
+        attach_device(device)
+
+    if args['--realtime']:
+        start_realtime()
+
+    if args['--metrics-file']:
+        write_metrics_periodically()
+
+    # Starting up isn't part of either phase
+    idle_tracker.reset()
 
-    # Try to start the driver. It will raise an error if the USB device is not available
     try:
-        evdev_is_running = True
-        run_evdev()
-    except:
+        loop.run()
+    finally:
+        if idle_collector:
+            idle_collector.close()
+
+        for device in devices:
+            if device.usb_device:
+                device.detach()
+            device.close_output()
+
+        if control_server:
+            control_server.close()
+
+        if recorder:
+            recorder.close()
+            if not args['--quiet-mode']:
+                print('Recorded {} reports to {}'.format(recorder.reports_written, args['--record']))
+
+        if args['--metrics-file']:
+            write_metrics(up=False)
+
         if not args['--quiet-mode']:
-            print('Error occured')
-        evdev_is_running = False
+            print(idle_tracker.format_stats())
+
+        if instance_lock:
+            instance_lock.release()
 
 if __name__ == '__main__':
     try:
         run_main()
-    except:
-        if not args['--quiet-mode']:
+    except Exception:
+        if not is_quiet():
             raise
-        exit()
+
+        import traceback
+        report_error(traceback.format_exc())
+        exit(1)
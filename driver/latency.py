@@ -0,0 +1,152 @@
+from array import array
+import time
+
+# CONSTANTS ---------------------------------------------------------------------------------------
+
+# Every histogram bucket is at most 1/2**(SUB_BUCKET_BITS-1) wide relative to its value, which is
+# ~6% with 5 bits. Values up to 2**MAX_SHIFT ns (~18 minutes) can be recorded
+SUB_BUCKET_BITS = 5
+SUB_BUCKET_COUNT = 1 << SUB_BUCKET_BITS
+SUB_BUCKET_HALF = SUB_BUCKET_COUNT >> 1
+MAX_SHIFT = 40
+
+# The stages that a report goes through. Every stage is the time between two timestamps:
+# read -> decoded -> smoothed -> handled -> synced
+STAGES = ('decode', 'smooth', 'action', 'uinput', 'total')
+
+# Smoothing filters also hold the pen back by their time constant. That delay isn't spent in the
+# driver so it is kept out of the total and reported on its own
+LAG = 'lag'
+
+PERCENTILES = (50.0, 99.0, 99.9)
+
+# HISTOGRAM ---------------------------------------------------------------------------------------
+
+class LatencyHistogram(object):
+    """
+    Log-linear (HDR style) histogram of nanosecond durations with a fixed number of buckets so
+    that recording a value never allocates
+    """
+
+    def __init__(self):
+        self.counts = array('Q', bytes(8 * (SUB_BUCKET_COUNT + MAX_SHIFT * SUB_BUCKET_HALF)))
+        self.total = 0
+        self.max = 0
+
+    def record(self, value):
+        if value < SUB_BUCKET_COUNT:
+            index = value if value > 0 else 0
+        else:
+            shift = min(value.bit_length() - SUB_BUCKET_BITS, MAX_SHIFT)
+            mantissa = min(value >> shift, SUB_BUCKET_COUNT - 1)
+            index = SUB_BUCKET_COUNT + (shift - 1) * SUB_BUCKET_HALF + mantissa - SUB_BUCKET_HALF
+
+        self.counts[index] += 1
+        self.total += 1
+        if value > self.max:
+            self.max = value
+
+    def bucket_upper_bound(self, index):
+        if index < SUB_BUCKET_COUNT:
+            return index
+
+        shift = (index - SUB_BUCKET_COUNT) // SUB_BUCKET_HALF + 1
+        mantissa = (index - SUB_BUCKET_COUNT) % SUB_BUCKET_HALF + SUB_BUCKET_HALF
+        return ((mantissa + 1) << shift) - 1
+
+    def percentile(self, percent):
+        if not self.total:
+            return 0
+
+        target = max(1, int(self.total * percent / 100.0 + 0.5))
+        seen = 0
+        for index, count in enumerate(self.counts):
+            seen += count
+            if seen >= target:
+                return min(self.bucket_upper_bound(index), self.max)
+
+        return self.max
+
+    def reset(self):
+        for index in range(len(self.counts)):
+            self.counts[index] = 0
+        self.total = 0
+        self.max = 0
+
+# RECORDER ----------------------------------------------------------------------------------------
+
+class LatencyRecorder(object):
+    """
+    Timestamps every report as it moves through the driver and records the time spent in every
+    stage in a histogram
+    """
+
+    def __init__(self):
+        self.histograms = dict((stage, LatencyHistogram()) for stage in STAGES + (LAG,))
+
+        self.read_ns = 0
+        self.decoded_ns = 0
+        self.smoothed_ns = 0
+        self.handled_ns = 0
+
+    def start(self, timestamp_ns=None):
+        # The report has just been returned by the USB read
+        self.read_ns = timestamp_ns or time.monotonic_ns()
+        self.decoded_ns = self.smoothed_ns = self.read_ns
+
+    def mark_decoded(self):
+        self.decoded_ns = self.smoothed_ns = time.monotonic_ns()
+
+    def mark_smoothed(self, lag_ns):
+        self.smoothed_ns = time.monotonic_ns()
+        self.histograms[LAG].record(lag_ns)
+
+    def mark_handled(self):
+        self.handled_ns = time.monotonic_ns()
+
+    def finish(self):
+        # The report's events have been written to uinput
+        synced_ns = time.monotonic_ns()
+
+        histograms = self.histograms
+        histograms['decode'].record(self.decoded_ns - self.read_ns)
+        histograms['smooth'].record(self.smoothed_ns - self.decoded_ns)
+        histograms['action'].record(self.handled_ns - self.smoothed_ns)
+        histograms['uinput'].record(synced_ns - self.handled_ns)
+        histograms['total'].record(synced_ns - self.read_ns)
+
+    def get_stages(self):
+        # The filter lag only shows up once a smoothing filter has been used
+        if self.histograms[LAG].total:
+            return STAGES + (LAG,)
+        return STAGES
+
+    def get_stats(self):
+        stats = {}
+        for stage in self.get_stages():
+            histogram = self.histograms[stage]
+            stage_stats = {'count': histogram.total, 'max': histogram.max}
+            for percent in PERCENTILES:
+                stage_stats['p{:g}'.format(percent)] = histogram.percentile(percent)
+            stats[stage] = stage_stats
+
+        return stats
+
+    def format_stats(self):
+        lines = ['{:<8}{:>10}{:>10}{:>10}{:>10}{:>10}'.format(
+            'stage', 'count', 'p50 us', 'p99 us', 'p99.9 us', 'max us'
+        )]
+
+        stats = self.get_stats()
+        for stage in self.get_stages():
+            stage_stats = stats[stage]
+            lines.append('{:<8}{:>10}{:>10.1f}{:>10.1f}{:>10.1f}{:>10.1f}'.format(
+                stage,
+                stage_stats['count'],
+                stage_stats['p50'] / 1000.0,
+                stage_stats['p99'] / 1000.0,
+                stage_stats['p99.9'] / 1000.0,
+                stage_stats['max'] / 1000.0,
+            ))
+
+        return '\n'.join(lines)
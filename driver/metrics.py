@@ -0,0 +1,116 @@
+from atomic_file import write_file_atomically
+from idle import PHASES
+
+# CONSTANTS ---------------------------------------------------------------------------------------
+
+METRIC_PREFIX = 'kamvas_'
+
+# HELPERS -----------------------------------------------------------------------------------------
+
+def escape_label(value):
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+def format_labels(labels):
+    return ','.join('{}="{}"'.format(name, escape_label(value)) for name, value in sorted(labels.items()))
+
+class MetricsText(object):
+    """
+    Builds the Prometheus text exposition format. Every metric is declared once with its type and
+    help text, followed by its samples. labels are added to every sample
+    """
+
+    def __init__(self, labels):
+        self.labels = labels
+        self.lines = []
+
+    def add(self, name, metric_type, help_text, samples):
+        # samples is a list of (labels, value)
+        name = METRIC_PREFIX + name
+        self.lines.append('# HELP {} {}'.format(name, help_text))
+        self.lines.append('# TYPE {} {}'.format(name, metric_type))
+        for labels, value in samples:
+            self.lines.append('{}{{{}}} {}'.format(name, format_labels(dict(self.labels, **labels)), value))
+
+    def get_text(self):
+        return '\n'.join(self.lines) + '\n'
+
+# METRICS -----------------------------------------------------------------------------------------
+
+def build_metrics(instance, uptime, devices, errors, idle_stats, up=True):
+    """
+    Returns the driver's counters in the Prometheus text format. devices are the TabletDevices
+    and errors counts the exceptions the driver caught and carried on after, by where they happened.
+    idle_stats come from IdleTracker.get_stats(). The driver writes the file one last time with up
+    set to False when it stops
+    """
+
+    metrics = MetricsText({'instance': instance})
+    metrics.add('up', 'gauge', 'Whether the driver is running', [({}, int(up))])
+    metrics.add('uptime_seconds', 'gauge', 'Seconds since the driver started', [({}, '{:.3f}'.format(uptime))])
+    metrics.add('errors_total', 'counter', 'Exceptions the driver caught and carried on after', [
+        ({'where': where}, count) for where, count in sorted(errors.items())
+    ])
+
+    for key, name, help_text in (
+        ('seconds', 'phase_seconds_total', 'Seconds that any tablet was active or all of them were idle'),
+        ('cpu_seconds', 'phase_cpu_seconds_total', 'CPU seconds the driver used while active or idle'),
+        ('wakeups', 'phase_wakeups_total', 'Times the driver loop woke up while active or idle'),
+    ):
+        metrics.add(name, 'counter', help_text, [
+            ({'phase': phase}, round(idle_stats[phase][key], 3)) for phase in PHASES
+        ])
+    metrics.add('idle_resumes_total', 'counter', 'Times a tablet woke the driver up from idle', [
+        ({}, idle_stats['resumes'])
+    ])
+
+    def per_device(get_value):
+        return [({'device': device.name}, get_value(device)) for device in devices]
+
+    metrics.add('device_attached', 'gauge', 'Whether the tablet is attached', per_device(
+        lambda device: int(bool(device.usb_device))
+    ))
+    metrics.add('reports_total', 'counter', 'USB reports processed by report ID', [
+        ({'device': device.name, 'report_id': report_id}, count)
+        for device in devices
+        for report_id, count in enumerate(device.report_counts)
+        if count
+    ])
+    metrics.add('read_timeouts_total', 'counter', 'USB reads that timed out without a report', per_device(
+        lambda device: device.read_timeouts
+    ))
+    metrics.add('usb_errors_total', 'counter', 'Failed USB reads and transfers by errno', [
+        ({'device': device.name, 'errno': name}, count)
+        for device in devices
+        for name, count in sorted(device.usb_errors.items())
+    ])
+    metrics.add('attaches_total', 'counter', 'Times the tablet was attached', per_device(
+        lambda device: device.attach_count
+    ))
+    metrics.add('reconnects_total', 'counter', 'Times the tablet was attached again after the first time', per_device(
+        lambda device: max(device.attach_count - 1, 0)
+    ))
+    metrics.add('disconnects_total', 'counter', 'Times the tablet was unplugged', per_device(
+        lambda device: device.disconnect_count
+    ))
+    metrics.add('attach_failures_total', 'counter', 'Attempts to attach the tablet that failed', per_device(
+        lambda device: device.attach_failures
+    ))
+    metrics.add('actions_total', 'counter', 'Button actions fired', per_device(
+        lambda device: device.actions_fired
+    ))
+
+    emitter_stats = dict((device.name, device.emitter.get_stats()) for device in devices if device.emitter)
+    for key, name, help_text in (
+        ('events_written', 'uinput_events_total', 'Events written to the virtual pen'),
+        ('events_suppressed', 'uinput_events_suppressed_total', 'Axis events dropped because the value did not change'),
+        ('frames_written', 'uinput_frames_total', 'SYN_REPORT frames written to the virtual pen'),
+    ):
+        metrics.add(name, 'counter', help_text, [
+            ({'device': device_name}, stats[key]) for device_name, stats in sorted(emitter_stats.items())
+        ])
+
+    return metrics.get_text()
+
+def write_metrics_file(path, text):
+    # A collector never reads half a file
+    write_file_atomically(path, text)
@@ -0,0 +1,65 @@
+from array import array
+
+# CONSTANTS ---------------------------------------------------------------------------------------
+
+# Curve points evaluated per table entry. Bezier curves are sampled by their parameter rather than
+# solved for every input, so this needs to be high enough that no entry is skipped over
+BEZIER_SAMPLES_PER_ENTRY = 2
+
+# HELPERS -----------------------------------------------------------------------------------------
+
+def evaluate_bezier(control_points, t):
+    # Cubic bezier from (0, 0) to (1, 1) with the two given control points
+    (x1, y1), (x2, y2) = control_points
+    u = 1 - t
+    x = 3 * u * u * t * x1 + 3 * u * t * t * x2 + t * t * t
+    y = 3 * u * u * t * y1 + 3 * u * t * t * y2 + t * t * t
+    return x, y
+
+def build_bezier_curve(control_points, size):
+    # Returns the curve's y for every x in steps of 1 / (size - 1). The control points are
+    # validated to keep x increasing with t so every entry gets filled in order
+    curve = [0.0] * size
+    samples = size * BEZIER_SAMPLES_PER_ENTRY
+    next_index = 0
+    for sample in range(samples + 1):
+        x, y = evaluate_bezier(control_points, sample / float(samples))
+        index = int(round(x * (size - 1)))
+        while next_index <= index and next_index < size:
+            curve[next_index] = y
+            next_index += 1
+
+    return curve
+
+# PRESSURE TABLE ----------------------------------------------------------------------------------
+
+def build_pressure_table(curve, max_pressure):
+    """
+    Turns a pressure_curve from the config into a table with an output pressure for every raw
+    pressure from 0 to max_pressure, so the pen handler only has to index it. Raw pressures below
+    min are dropped to 0 and ones above max give full pressure. What is in between is stretched
+    over the whole range and shaped by either gamma or the bezier control points
+    """
+
+    size = max_pressure + 1
+    min_pressure = curve.get('min', 0.0)
+    max_clamp = curve.get('max', 1.0)
+    gamma = curve.get('gamma', 1.0)
+
+    bezier = None
+    if curve.get('bezier'):
+        bezier = build_bezier_curve(curve['bezier'], size)
+
+    table = array('I', bytes(4 * size))
+    for raw_pressure in range(size):
+        x = (raw_pressure / float(max_pressure) - min_pressure) / (max_clamp - min_pressure)
+        x = min(max(x, 0.0), 1.0)
+
+        if bezier:
+            y = bezier[int(round(x * max_pressure))]
+        else:
+            y = x ** gamma
+
+        table[raw_pressure] = int(round(min(max(y, 0.0), 1.0) * max_pressure))
+
+    return table
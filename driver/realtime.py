@@ -0,0 +1,189 @@
+import os
+import gc
+
+from latency import LatencyHistogram
+
+# CONSTANTS ---------------------------------------------------------------------------------------
+
+SCHEDULING_POLICIES = {
+    'fifo': ('SCHED_FIFO', os.SCHED_FIFO),
+    'rr': ('SCHED_RR', os.SCHED_RR),
+}
+
+# From sys/mman.h
+MCL_CURRENT = 1
+MCL_FUTURE = 2
+
+# The garbage collector runs once every time all the tablets go idle, or when a tablet has been
+# active for this long without a break, so that a pen that is never put down can't make the
+# garbage grow without bounds. The driver's report path makes next to no cyclic garbage
+GC_MAX_INTERVAL_S = 300.0
+
+# Report intervals longer than this are pauses in the pen movement, not jitter
+MAX_REPORT_INTERVAL_NS = 50000000
+
+# How often the report interval jitter of every tablet is printed
+JITTER_PRINT_INTERVAL_S = 10.0
+
+# HELPERS -----------------------------------------------------------------------------------------
+
+def set_scheduler(policy, priority):
+    # Programs that the driver runs, like xinput, go back to the normal policy
+    name, policy_id = SCHEDULING_POLICIES[policy]
+    os.sched_setscheduler(0, policy_id | os.SCHED_RESET_ON_FORK, os.sched_param(priority))
+    return '{} priority {}'.format(name, priority)
+
+def set_affinity(cpus):
+    os.sched_setaffinity(0, cpus)
+    return 'CPUs {}'.format(','.join(str(cpu) for cpu in sorted(cpus)))
+
+def lock_memory():
+    import ctypes
+
+    # Keeps the driver's pages from being swapped out or paged in on the report path
+    libc = ctypes.CDLL(None, use_errno=True)
+    if libc.mlockall(MCL_CURRENT | MCL_FUTURE) != 0:
+        error = ctypes.get_errno()
+        raise OSError(error, os.strerror(error))
+    return 'memory locked'
+
+def parse_cpus(text):
+    # Takes a list like 2,3 or a range like 2-5
+    cpus = set()
+    for part in text.split(','):
+        if '-' in part:
+            first, last = part.split('-')
+            cpus.update(range(int(first), int(last) + 1))
+        else:
+            cpus.add(int(part))
+    return cpus
+
+# REALTIME MODE -----------------------------------------------------------------------------------
+
+def enable_realtime(policy, priority, cpus=None):
+    """
+    Moves the driver to a real-time scheduling policy, pins it to the given CPUs and locks its
+    memory. Every step that fails, usually because the driver lacks CAP_SYS_NICE or
+    CAP_IPC_LOCK, is skipped so the driver still runs, just without that guarantee. Returns
+    (what was enabled, what failed) as lists of messages
+    """
+
+    steps = [('scheduling', lambda: set_scheduler(policy, priority))]
+    if cpus:
+        steps.append(('CPU affinity', lambda: set_affinity(cpus)))
+    steps.append(('memory locking', lock_memory))
+
+    enabled = []
+    failed = []
+    for name, step in steps:
+        try:
+            enabled.append(step())
+        except (OSError, ValueError) as e:
+            failed.append('{} ({})'.format(name, e))
+
+    return enabled, failed
+
+class IdleCollector(object):
+    """
+    Keeps the cyclic garbage collector from pausing the report path. Everything allocated during
+    startup is frozen once so it is never scanned again and automatic collections are turned off.
+    idle_tracker tells the collector when all the tablets go idle, which is when it collects, once
+    per idle period. Nothing runs while they stay idle
+    """
+
+    def __init__(self, loop, idle_tracker):
+        self.loop = loop
+        self.collections = 0
+        self.collected = 0
+        self.active_timer = None
+
+        gc.collect()
+        gc.freeze()
+        gc.disable()
+
+        idle_tracker.add_listener(self.handle_phase_change)
+        if not idle_tracker.all_idle:
+            self.handle_phase_change(False)
+
+    def handle_phase_change(self, all_idle):
+        if self.active_timer:
+            self.loop.cancel(self.active_timer)
+            self.active_timer = None
+
+        if all_idle:
+            # Run from the loop rather than from whatever noticed the tablets going idle
+            self.loop.call_later(0, self.collect)
+        else:
+            self.active_timer = self.loop.call_later(GC_MAX_INTERVAL_S, self.collect_while_active)
+
+    def collect_while_active(self):
+        self.collect()
+        self.active_timer = self.loop.call_later(GC_MAX_INTERVAL_S, self.collect_while_active)
+
+    def collect(self):
+        # Objects that survive aren't frozen. Anything frozen that later became cyclic garbage
+        # would never be freed
+        self.collected += gc.collect()
+        self.collections += 1
+
+    def get_stats(self):
+        return {
+            'collections': self.collections,
+            'collected': self.collected,
+            'frozen': gc.get_freeze_count(),
+        }
+
+    def close(self):
+        if self.active_timer:
+            self.loop.cancel(self.active_timer)
+        gc.unfreeze()
+        gc.enable()
+
+# JITTER ------------------------------------------------------------------------------------------
+
+class ReportJitter(object):
+    """
+    How steadily the reports of a tablet are read. The tablet sends them at a fixed rate, so any
+    difference between one report interval and the next is time that the driver's reads got held
+    up or bunched together. Those differences go into a histogram because its buckets are fine
+    grained for small values, unlike for the intervals themselves
+    """
+
+    def __init__(self):
+        self.histogram = LatencyHistogram()
+        self.previous_ns = 0
+        self.previous_interval = 0
+        self.interval_total = 0
+
+    def record(self, timestamp_ns):
+        interval = timestamp_ns - self.previous_ns
+        self.previous_ns = timestamp_ns
+        if interval > MAX_REPORT_INTERVAL_NS:
+            self.previous_interval = 0
+            return
+
+        if self.previous_interval:
+            change = interval - self.previous_interval
+            self.histogram.record(change if change > 0 else -change)
+            self.interval_total += interval
+        self.previous_interval = interval
+
+    def get_stats(self):
+        histogram = self.histogram
+        return {
+            'intervals': histogram.total,
+            'mean_interval_us': self.interval_total / 1000.0 / histogram.total if histogram.total else 0.0,
+            'jitter_p50_us': histogram.percentile(50.0) / 1000.0,
+            'jitter_p99_us': histogram.percentile(99.0) / 1000.0,
+            'jitter_max_us': histogram.max / 1000.0,
+        }
+
+    def format_stats(self):
+        return 'Report interval {mean_interval_us:.0f} us, jitter p50 {jitter_p50_us:.0f} us, ' \
+            'p99 {jitter_p99_us:.0f} us, max {jitter_max_us:.0f} us over {intervals} reports'.format(
+                **self.get_stats()
+            )
+
+    def reset(self):
+        self.histogram.reset()
+        self.interval_total = 0
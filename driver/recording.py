@@ -0,0 +1,64 @@
+import struct
+
+# CONSTANTS ---------------------------------------------------------------------------------------
+
+RECORDING_MAGIC = b'KVRC'
+RECORDING_VERSION = 1
+
+# File header: magic, version
+HEADER = struct.Struct('<4sB')
+
+# Every report is stored as the microseconds since the previous report, the report length and
+# then the raw report bytes
+REPORT_HEADER = struct.Struct('<IB')
+
+# RECORDING ---------------------------------------------------------------------------------------
+
+class ReportRecorder(object):
+    """
+    Writes raw USB reports along with the time they were read to a compact binary file that can
+    be fed back through the driver with --replay
+    """
+
+    def __init__(self, path):
+        self.file = open(path, 'wb')
+        self.file.write(HEADER.pack(RECORDING_MAGIC, RECORDING_VERSION))
+        self.previous_timestamp_ns = None
+        self.reports_written = 0
+
+    def write(self, data, length, timestamp_ns):
+        if self.previous_timestamp_ns is None:
+            delta_us = 0
+        else:
+            delta_us = min((timestamp_ns - self.previous_timestamp_ns) // 1000, 0xffffffff)
+        self.previous_timestamp_ns = timestamp_ns
+
+        self.file.write(REPORT_HEADER.pack(delta_us, length))
+        self.file.write(memoryview(data)[:length])
+        self.reports_written += 1
+
+    def close(self):
+        self.file.close()
+
+def read_recording(path):
+    # Yields (nanoseconds since the first report, report bytes) for every report in the file
+    with open(path, 'rb') as recording:
+        magic, version = HEADER.unpack(recording.read(HEADER.size))
+        if magic != RECORDING_MAGIC:
+            raise Exception('{} is not a kamvas recording'.format(path))
+        if version != RECORDING_VERSION:
+            raise Exception('Unsupported recording version {} in {}'.format(version, path))
+
+        timestamp_ns = 0
+        while True:
+            report_header = recording.read(REPORT_HEADER.size)
+            if len(report_header) < REPORT_HEADER.size:
+                return
+
+            delta_us, length = REPORT_HEADER.unpack(report_header)
+            data = recording.read(length)
+            if len(data) < length:
+                return
+
+            timestamp_ns += delta_us * 1000
+            yield timestamp_ns, data
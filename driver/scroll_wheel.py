@@ -0,0 +1,69 @@
+# CONSTANTS ---------------------------------------------------------------------------------------
+
+# REL_WHEEL_HI_RES units in one REL_WHEEL detent, as defined by the kernel
+HI_RES_PER_DETENT = 120
+
+# The scrolling speed is measured over at most this long. Anything slower counts as slow
+VELOCITY_WINDOW_NS = 250000000
+
+# SCROLL WHEEL ------------------------------------------------------------------------------------
+
+class ScrollWheel(object):
+    """
+    Turns scrollbar steps into mouse wheel movement. Steps are sent right away unless the wheel
+    already moved less than frame_ms ago, in which case they are added up and sent together once
+    the frame is over. That way an application redraws at most once per frame however fast the
+    finger moves. Fast movements are sped up by acceleration: the steps are multiplied by
+    1 + acceleration * steps per second, up to max_multiplier. step is how far one scrollbar step
+    moves the wheel in REL_WHEEL_HI_RES units
+    """
+
+    def __init__(self, frame_ms=16, step=HI_RES_PER_DETENT, acceleration=0.0, max_multiplier=4.0,
+                 invert=False):
+        self.frame_ns = int(frame_ms * 1e6)
+        self.step = step
+        self.acceleration = acceleration
+        self.max_multiplier = max_multiplier
+
+        # Moving down the scrollbar scrolls down, which is a negative wheel movement
+        self.direction = 1 if invert else -1
+        self.reset()
+
+    def reset(self):
+        self.pending_steps = 0
+        self.previous_ns = None
+        # Hi res movement that hasn't added up to a whole detent yet
+        self.hi_res_remainder = 0
+
+        # The movement of the last frame, read by the caller after take()
+        self.hi_res = 0
+        self.detents = 0
+
+    def add_steps(self, steps, timestamp_ns):
+        # Returns True when the frame is over and the steps can be taken right away
+        self.pending_steps += steps
+        return self.previous_ns is None or timestamp_ns - self.previous_ns >= self.frame_ns
+
+    def get_flush_time_ns(self):
+        return self.previous_ns + self.frame_ns
+
+    def take(self, timestamp_ns):
+        steps = self.pending_steps
+        self.pending_steps = 0
+
+        multiplier = 1.0
+        if self.acceleration:
+            elapsed_ns = VELOCITY_WINDOW_NS
+            if self.previous_ns is not None:
+                elapsed_ns = min(max(timestamp_ns - self.previous_ns, self.frame_ns), VELOCITY_WINDOW_NS)
+            velocity = abs(steps) * 1e9 / elapsed_ns
+            multiplier = min(1.0 + self.acceleration * velocity, self.max_multiplier)
+        self.previous_ns = timestamp_ns
+
+        self.hi_res = int(round(steps * self.step * multiplier)) * self.direction
+
+        # Whole detents for applications that only know REL_WHEEL. Rounded towards zero so that
+        # the remainder keeps the sign of the movement
+        total = self.hi_res_remainder + self.hi_res
+        self.detents = int(total / float(HI_RES_PER_DETENT))
+        self.hi_res_remainder = total - self.detents * HI_RES_PER_DETENT
@@ -0,0 +1,132 @@
+import math
+from array import array
+
+# CONSTANTS ---------------------------------------------------------------------------------------
+
+FILTERS = ('one_euro', 'ema')
+
+# Used when two reports carry the same timestamp, which only happens with synthetic input
+DEFAULT_REPORT_INTERVAL_NS = 5000000
+
+# After a gap this long the pen has most likely been lifted away and put down somewhere else, so
+# the filter starts over instead of drawing a line from the old position. It also starts over when
+# the time goes backwards, which happens when a replay starts again
+RESET_INTERVAL_NS = 100000000
+
+# The EMA looks its smoothing factor up by the report interval in steps of this size
+EMA_INTERVAL_STEP_NS = 100000
+EMA_SHIFT = 16
+
+# FILTERS -----------------------------------------------------------------------------------------
+
+class OneEuroSmoother(object):
+    """
+    1 euro filter (Casiez et al. 2012) on X and Y. The cutoff frequency rises with the speed of
+    the pen, so slow movements get smoothed heavily while fast strokes barely lag behind. All of
+    the state lives in plain attributes so nothing is allocated per report apart from the floats
+    the arithmetic produces. The smoothed values are left in x and y
+    """
+
+    def __init__(self, min_cutoff=1.0, beta=0.007, derivative_cutoff=1.0):
+        self.min_cutoff = float(min_cutoff)
+        self.beta = float(beta)
+        self.derivative_cutoff = float(derivative_cutoff)
+        self.reset()
+
+    def reset(self):
+        self.previous_ns = None
+        self.filtered_x = 0.0
+        self.filtered_y = 0.0
+        self.derivative_x = 0.0
+        self.derivative_y = 0.0
+        self.cutoff = self.min_cutoff
+        self.x = 0
+        self.y = 0
+
+    def smooth(self, x, y, timestamp_ns):
+        previous_ns = self.previous_ns
+        self.previous_ns = timestamp_ns
+        if previous_ns is None or not 0 <= timestamp_ns - previous_ns <= RESET_INTERVAL_NS:
+            self.filtered_x = float(x)
+            self.filtered_y = float(y)
+            self.derivative_x = self.derivative_y = 0.0
+            self.x = x
+            self.y = y
+            return
+
+        interval = (timestamp_ns - previous_ns or DEFAULT_REPORT_INTERVAL_NS) * 1e-9
+
+        # Smoothing factor of a first order low pass filter: r / (r + 1) with r = 2 pi fc dt
+        r = 2 * math.pi * self.derivative_cutoff * interval
+        derivative_alpha = r / (r + 1)
+        self.derivative_x += derivative_alpha * ((x - self.filtered_x) / interval - self.derivative_x)
+        self.derivative_y += derivative_alpha * ((y - self.filtered_y) / interval - self.derivative_y)
+
+        speed = math.hypot(self.derivative_x, self.derivative_y)
+        self.cutoff = cutoff = self.min_cutoff + self.beta * speed
+        r = 2 * math.pi * cutoff * interval
+        alpha = r / (r + 1)
+        self.filtered_x += alpha * (x - self.filtered_x)
+        self.filtered_y += alpha * (y - self.filtered_y)
+
+        self.x = int(self.filtered_x + 0.5)
+        self.y = int(self.filtered_y + 0.5)
+
+    def get_lag_ns(self):
+        # Time constant of the filter at its current cutoff frequency
+        return int(1e9 / (2 * math.pi * self.cutoff))
+
+class EmaSmoother(object):
+    """
+    Exponential moving average on X and Y in fixed point. The smoothing factor for a given report
+    interval comes from a table built up front, so the per-report work is integer arithmetic
+    only. time_constant_ms is how long the average takes to cover about 63% of a jump
+    """
+
+    def __init__(self, time_constant_ms=8.0):
+        self.time_constant_ns = time_constant_ms * 1e6
+
+        # alpha = 1 - e^(-dt / tau) for every interval up to the reset interval
+        steps = RESET_INTERVAL_NS // EMA_INTERVAL_STEP_NS + 1
+        self.alphas = array('l', [
+            int(round((1 - math.exp(-step * EMA_INTERVAL_STEP_NS / self.time_constant_ns)) * (1 << EMA_SHIFT)))
+            for step in range(steps)
+        ])
+        self.default_alpha = self.alphas[DEFAULT_REPORT_INTERVAL_NS // EMA_INTERVAL_STEP_NS]
+        self.reset()
+
+    def reset(self):
+        self.previous_ns = None
+        self.state_x = 0
+        self.state_y = 0
+        self.x = 0
+        self.y = 0
+
+    def smooth(self, x, y, timestamp_ns):
+        previous_ns = self.previous_ns
+        self.previous_ns = timestamp_ns
+        if previous_ns is None or not 0 <= timestamp_ns - previous_ns <= RESET_INTERVAL_NS:
+            self.state_x = x << EMA_SHIFT
+            self.state_y = y << EMA_SHIFT
+            self.x = x
+            self.y = y
+            return
+
+        alpha = self.alphas[(timestamp_ns - previous_ns) // EMA_INTERVAL_STEP_NS] or self.default_alpha
+        self.state_x += ((x << EMA_SHIFT) - self.state_x) * alpha >> EMA_SHIFT
+        self.state_y += ((y << EMA_SHIFT) - self.state_y) * alpha >> EMA_SHIFT
+
+        self.x = (self.state_x + (1 << (EMA_SHIFT - 1))) >> EMA_SHIFT
+        self.y = (self.state_y + (1 << (EMA_SHIFT - 1))) >> EMA_SHIFT
+
+    def get_lag_ns(self):
+        return int(self.time_constant_ns)
+
+def create_smoother(settings):
+    # settings is a profile's smoothing section from the config
+    settings = dict(settings)
+    smoothing_filter = settings.pop('filter')
+    if smoothing_filter == 'one_euro':
+        return OneEuroSmoother(**settings)
+
+    return EmaSmoother(**settings)
@@ -0,0 +1,89 @@
+from __future__ import print_function
+import os
+import json
+import time
+
+import usb.core
+import usb.util
+
+from atomic_file import write_file_atomically
+
+# CONSTANTS ---------------------------------------------------------------------------------------
+
+DEFAULT_PROBE_CACHE_PATH = '/var/cache/kamvas/probe_cache.json'
+
+# Huion tablets only start sending reports in their full resolution mode after these string
+# descriptors have been read. Index 0 is the language table so a full probe starts at 1
+WAKE_STRING_INDICES = (0x64, 0xc8)
+FULL_PROBE_INDICES = range(1, 256)
+
+# HELPERS -----------------------------------------------------------------------------------------
+
+def read_string(device, index):
+    try:
+        return usb.util.get_string(device, index)
+    except (usb.core.USBError, ValueError):
+        # Most indices are not defined by the firmware and the request just fails
+        return None
+
+def get_cache_key(device):
+    serial = read_string(device, device.iSerialNumber) if device.iSerialNumber else ''
+    return '{:04x}:{:04x}:{}'.format(device.idVendor, device.idProduct, serial or '')
+
+def load_cache(path):
+    try:
+        with open(path, 'r') as cache_file:
+            return json.load(cache_file)
+    except (IOError, OSError, ValueError):
+        return {}
+
+def save_cache(path, cache):
+    directory = os.path.dirname(path)
+    if directory and not os.path.isdir(directory):
+        os.makedirs(directory)
+
+    write_file_atomically(path, json.dumps(cache, indent=4, sort_keys=True))
+
+# PROBE -------------------------------------------------------------------------------------------
+
+def probe_tablet(device, cache_path=DEFAULT_PROBE_CACHE_PATH, full_probe=False, quiet=False):
+    """
+    Reads the string descriptors that put the tablet into the right mode. The first time a tablet
+    is seen (or with full_probe) all 255 indices are requested and the results are cached by
+    vendor, product and serial. After that only the indices that are known to wake the firmware
+    are requested. Returns the tablet's strings as [hex index, string] pairs
+    """
+
+    cache = load_cache(cache_path)
+    key = get_cache_key(device)
+    entry = cache.get(key)
+
+    if entry and not full_probe:
+        for index in entry['wake_indices']:
+            read_string(device, index)
+
+        strings = dict((int(index), string) for index, string in entry['strings'].items())
+        return [[hex(index), strings[index]] for index in sorted(strings)]
+
+    strings = {}
+    for index in FULL_PROBE_INDICES:
+        result = read_string(device, index)
+        if result is not None:
+            strings[index] = result
+
+    # Fall back to every index that answered if the firmware doesn't define the known ones
+    wake_indices = [index for index in WAKE_STRING_INDICES if index in strings] or sorted(strings)
+
+    cache[key] = {
+        'strings': dict((str(index), string) for index, string in strings.items()),
+        'wake_indices': wake_indices,
+        'probed_at': time.time(),
+    }
+
+    try:
+        save_cache(cache_path, cache)
+    except (IOError, OSError) as e:
+        if not quiet:
+            print('Could not write the probe cache to {}: {}'.format(cache_path, e))
+
+    return [[hex(index), strings[index]] for index in sorted(strings)]
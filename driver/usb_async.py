@@ -0,0 +1,219 @@
+import select
+import selectors
+
+# libusb1 is only needed for asynchronous transfers so the driver still works without it
+try:
+    import usb1
+except ImportError:
+    usb1 = None
+
+# CONSTANTS ---------------------------------------------------------------------------------------
+
+# How many times to wait for cancelled transfers to come back before giving up on them
+CLOSE_ATTEMPTS = 10
+
+# How many times a stalled endpoint is cleared without a report coming through in between before
+# the tablet is given up on
+MAX_HALT_CLEARS = 3
+
+# The errno that pyusb would have raised for each failed transfer status
+TRANSFER_ERRNO_NAMES = {
+    'TRANSFER_ERROR': 'EIO',
+    'TRANSFER_TIMED_OUT': 'ETIMEDOUT',
+    'TRANSFER_STALL': 'EPIPE',
+    'TRANSFER_OVERFLOW': 'EOVERFLOW',
+}
+
+# ASYNC READER ------------------------------------------------------------------------------------
+
+class AsyncTabletReader(object):
+    """
+    Keeps several interrupt transfers queued on the tablet's endpoint at all times so that there
+    is never a gap without a transfer waiting for the next report. Completed transfers are
+    handed to on_report and submitted again straight away. libusb's file descriptors are watched
+    by the driver's event loop so the process only wakes up when a transfer completes. Failed
+    transfers are passed to on_error by the name of the matching errno before they are resubmitted.
+    Stalled transfers wait until the endpoint's halt has been cleared
+    """
+
+    def __init__(self, loop, bus, address, interface, endpoint_address, packet_size,
+                 transfer_count, on_report, on_disconnect, on_error=None):
+        if usb1 is None:
+            raise Exception(
+                'Asynchronous transfers need the libusb1 python module. '
+                'Install it with "pip install libusb1"'
+            )
+
+        self.loop = loop
+        self.on_report = on_report
+        self.on_disconnect = on_disconnect
+        self.on_error = on_error
+        self.interface = interface
+        self.endpoint_address = endpoint_address
+        self.watched_fds = set()
+        self.closing = False
+        self.disconnected = False
+
+        # Transfers that stalled and the halt clears since the last report
+        self.stalled_transfers = []
+        self.halt_clears = 0
+
+        self.error_names = dict(
+            (getattr(usb1, status), errno_name) for status, errno_name in TRANSFER_ERRNO_NAMES.items()
+        )
+
+        self.context = usb1.USBContext()
+        self.context.open()
+        # Open the device by its place on the bus because several tablets of the same model share
+        # the same vendor and product IDs
+        self.handle = None
+        try:
+            for device in self.context.getDeviceIterator(skip_on_error=True):
+                if device.getBusNumber() == bus and device.getDeviceAddress() == address:
+                    self.handle = device.open()
+                    break
+
+            if self.handle is None:
+                raise Exception('Could not open the device for asynchronous transfers')
+
+            self.handle.claimInterface(interface)
+        except Exception:
+            if self.handle:
+                self.handle.close()
+            self.context.close()
+            raise
+
+        # Every transfer reads straight into its own buffer. The buffer's memoryview is passed
+        # as the user data so the callback doesn't need to look it up
+        self.transfers = []
+        for _ in range(transfer_count):
+            buffer = bytearray(packet_size)
+            transfer = self.handle.getTransfer()
+            transfer.setInterrupt(
+                endpoint_address,
+                buffer,
+                callback=self.handle_transfer,
+                user_data=memoryview(buffer),
+            )
+            self.transfers.append(transfer)
+
+        for fd, events in self.context.getPollFDList():
+            self.watch_fd(fd, events)
+        self.context.setPollFDNotifiers(self.handle_fd_added, self.handle_fd_removed)
+
+        for transfer in self.transfers:
+            transfer.submit()
+
+    def watch_fd(self, fd, events):
+        # usbfs signals completed transfers as writable so both directions have to be watched
+        selector_events = 0
+        if events & select.POLLIN:
+            selector_events |= selectors.EVENT_READ
+        if events & select.POLLOUT:
+            selector_events |= selectors.EVENT_WRITE
+
+        if fd in self.watched_fds:
+            self.loop.remove_watch(fd)
+        self.loop.add_watch(fd, selector_events, self.handle_events)
+        self.watched_fds.add(fd)
+
+    def handle_fd_added(self, fd, events, user_data=None):
+        self.watch_fd(fd, events)
+
+    def handle_fd_removed(self, fd, user_data=None):
+        if fd in self.watched_fds:
+            self.loop.remove_watch(fd)
+            self.watched_fds.discard(fd)
+
+    def handle_events(self):
+        # Runs the callbacks of any completed transfers without blocking
+        self.context.handleEventsTimeout(0)
+
+    def handle_transfer(self, transfer):
+        if self.closing or self.disconnected:
+            return
+
+        status = transfer.getStatus()
+        if status == usb1.TRANSFER_COMPLETED:
+            self.halt_clears = 0
+            self.on_report(transfer.getUserData(), transfer.getActualLength())
+        elif status == usb1.TRANSFER_NO_DEVICE:
+            # libusb can't be closed from inside one of its own callbacks so let the loop
+            # report the disconnect once this round of events has been handled
+            self.disconnected = True
+            self.loop.call_later(0, self.on_disconnect)
+            return
+        elif status == usb1.TRANSFER_CANCELLED:
+            return
+        elif self.on_error:
+            self.on_error(self.error_names.get(status, 'EIO'))
+
+        if status == usb1.TRANSFER_STALL:
+            # Resubmitting to a halted endpoint just stalls again. Clearing the halt is a
+            # synchronous request that libusb doesn't allow from inside its callbacks, so it is
+            # left to the loop
+            if not self.stalled_transfers:
+                self.loop.call_later(0, self.clear_halt)
+            self.stalled_transfers.append(transfer)
+            return
+
+        # Queue the transfer again, including after timeouts
+        transfer.submit()
+
+    def clear_halt(self):
+        if self.closing or self.disconnected:
+            return
+
+        self.halt_clears += 1
+        if self.halt_clears > MAX_HALT_CLEARS:
+            # The endpoint keeps stalling so the tablet is treated like it has been unplugged
+            self.disconnected = True
+            self.on_disconnect()
+            return
+
+        stalled_transfers = self.stalled_transfers
+        self.stalled_transfers = []
+        try:
+            self.handle.clearHalt(self.endpoint_address)
+        except usb1.USBErrorNoDevice:
+            self.disconnected = True
+            self.on_disconnect()
+            return
+        except usb1.USBError:
+            # The transfers are resubmitted anyway. If they stall again that counts as another
+            # clear
+            if self.on_error:
+                self.on_error('EIO')
+
+        for transfer in stalled_transfers:
+            transfer.submit()
+
+    def close(self):
+        self.closing = True
+
+        for transfer in self.transfers:
+            if transfer.isSubmitted():
+                try:
+                    transfer.cancel()
+                except usb1.USBError:
+                    pass
+
+        # Let libusb deliver the cancellations before the transfers are freed
+        for _ in range(CLOSE_ATTEMPTS):
+            if not any(transfer.isSubmitted() for transfer in self.transfers):
+                break
+            self.context.handleEventsTimeout(0.1)
+
+        for fd in list(self.watched_fds):
+            self.handle_fd_removed(fd)
+        self.context.setPollFDNotifiers(None, None)
+
+        try:
+            self.handle.releaseInterface(self.interface)
+        except usb1.USBError:
+            pass
+
+        for transfer in self.transfers:
+            transfer.close()
+        self.handle.close()
+        self.context.close()
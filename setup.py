@@ -33,8 +33,10 @@ setuptools.setup(
         'pyusb',
         'evdev',
         'pyyaml',
-        'psutil',
         'elevate',
         'pyudev',
     ],
+    extras_require = {
+        'async': ['libusb1'],
+    },
 )